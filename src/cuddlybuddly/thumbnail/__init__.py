@@ -26,25 +26,19 @@ def get_default_processor():
     return DEFAULT_PROCESSOR
 
 
-def autodiscover():
-    from django.conf import settings
-    cache = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_CACHE', None)
-    if cache is None:
-        return
-
-    global LOADING
-    if LOADING:
-        return
-    LOADING = True
-
+def find_file_models():
+    """
+    Return a list of every model in ``INSTALLED_APPS`` that has a file field
+    along with the names of those fields.
+    """
     import imp
+    from django.conf import settings
     from django.db.models import Model
     from django.db.models.base import ModelBase
     from django.db.models.fields.files import FieldFile
-    from django.db.models.signals import post_save, pre_delete
     from django.utils.importlib import import_module
-    from cuddlybuddly.thumbnail.listeners import update_cache
 
+    found = []
     for app in settings.INSTALLED_APPS:
         try:
             app_path = import_module(app).__path__
@@ -60,8 +54,31 @@ def autodiscover():
         for model in models.__dict__.values():
             if isinstance(model, ModelBase) and model is not Model:
                 modelinit = model()
+                fields = []
                 for field in modelinit.__dict__.keys():
                     if isinstance(getattr(modelinit, field, None), FieldFile):
-                        post_save.connect(update_cache, sender=model)
-                        pre_delete.connect(update_cache, sender=model)
+                        fields.append(field)
+                if fields:
+                    found.append((model, fields))
+    return found
+
+
+def autodiscover():
+    from django.conf import settings
+    from cuddlybuddly.thumbnail.metadata import get_backend
+    freshness = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_TTL', 0)
+    if get_backend() is None and not freshness:
+        return
+
+    global LOADING
+    if LOADING:
+        return
+    LOADING = True
+
+    from django.db.models.signals import post_save, pre_delete
+    from cuddlybuddly.thumbnail.listeners import update_cache
+
+    for model, fields in find_file_models():
+        post_save.connect(update_cache, sender=model)
+        pre_delete.connect(update_cache, sender=model)
     LOADING = False
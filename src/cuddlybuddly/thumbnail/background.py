@@ -0,0 +1,108 @@
+import logging
+import threading
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+from django.utils.encoding import force_unicode
+
+
+logger = logging.getLogger('cuddlybuddly.thumbnail')
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class BaseQueue(object):
+    """
+    Somewhere to put thumbnails that need generating so that the request which
+    noticed them doesn't have to wait around.
+    """
+
+    def put(self, thumbnail):
+        """
+        Queue the thumbnail for generation. Should return False if a thumbnail
+        with the same destination is already waiting, otherwise True.
+        """
+        raise NotImplementedError()
+
+    def join(self):
+        """
+        Block until everything queued so far has been generated.
+        """
+        raise NotImplementedError()
+
+
+class ThreadQueue(BaseQueue):
+    """
+    Generates thumbnails in daemon threads inside the current process. Jobs are
+    deduplicated by the destination name so a busy page only ever queues each
+    thumbnail once.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = getattr(settings,
+                              'CUDDLYBUDDLY_THUMBNAIL_BACKGROUND_WORKERS', 2)
+        self.workers = int(workers)
+        self.queue = Queue()
+        self.pending = set()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def put(self, thumbnail):
+        key = force_unicode(thumbnail.dest)
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+            self._start_workers()
+        finally:
+            self.lock.release()
+        self.queue.put((key, thumbnail))
+        return True
+
+    def join(self):
+        self.queue.join()
+
+    def _start_workers(self):
+        self.threads = [t for t in self.threads if t.isAlive()]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            key, thumbnail = self.queue.get()
+            try:
+                try:
+                    thumbnail._generate_once()
+                except Exception:
+                    logger.exception('Failed to generate thumbnail: %s' % key)
+            finally:
+                self.lock.acquire()
+                try:
+                    self.pending.discard(key)
+                finally:
+                    self.lock.release()
+                self.queue.task_done()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        _queue_lock.acquire()
+        try:
+            if _queue is None:
+                _queue = get_callable(getattr(
+                    settings, 'CUDDLYBUDDLY_THUMBNAIL_BACKGROUND_QUEUE',
+                    'cuddlybuddly.thumbnail.background.ThreadQueue'
+                ))()
+        finally:
+            _queue_lock.release()
+    return _queue
@@ -0,0 +1,448 @@
+"""
+Benchmarks the thumbnail pipeline over a synthetic corpus of images, timing
+each stage of generating a thumbnail with every registered processor, and
+each of the given ways of resampling, on both the local disk and an in-memory
+storage that simulates a remote one.
+
+It can be run against a project's settings or, without them, with settings
+of its own::
+
+    python -m cuddlybuddly.thumbnail.benchmark --output before.json
+    python -m cuddlybuddly.thumbnail.benchmark --compare before.json
+    python -m cuddlybuddly.thumbnail.benchmark -s quality -s balanced -s fast
+
+The results are written as JSON so that runs from different versions can be
+compared, and ``--compare`` exits with a non-zero status if anything got
+slower by more than ``--threshold``.
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from optparse import OptionParser
+try:
+    import resource
+except ImportError:
+    # Windows doesn't have it, so peak memory isn't reported there.
+    resource = None
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    import Image, ImageDraw
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from cuddlybuddly.thumbnail import PROCESSORS
+from cuddlybuddly.thumbnail.processors import RESAMPLE
+
+
+# The sizes of the source images and the thumbnails generated from each.
+SOURCE_SIZES = ((640, 480), (1600, 1200), (3200, 2400))
+THUMBNAIL_SIZES = ((80, 60), (320, 240))
+# The formats and modes of the source images.
+SOURCE_TYPES = (
+    ('JPEG', 'RGB'),
+    ('JPEG', 'L'),
+    ('PNG', 'RGB'),
+    ('PNG', 'RGBA'),
+    ('PNG', 'P'),
+    ('GIF', 'P'),
+)
+STAGES = ('check', 'open', 'decode', 'process', 'encode', 'store')
+
+
+def make_image(size, mode, seed=0):
+    """
+    Draw something with enough detail in it that it doesn't compress to
+    nothing, the same every time for the same arguments.
+    """
+    rand = random.Random(seed)
+    image = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    for i in range(200):
+        x = rand.randint(0, size[0])
+        y = rand.randint(0, size[1])
+        r = rand.randint(size[0] // 50, size[0] // 5)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(
+            rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255)
+        ))
+    del draw
+    if mode == 'RGBA':
+        alpha = Image.new('L', size, 0)
+        draw = ImageDraw.Draw(alpha)
+        draw.ellipse((0, 0) + size, fill=255)
+        del draw
+        image.putalpha(alpha)
+    elif mode == 'P':
+        image = image.convert('P', palette=Image.ADAPTIVE)
+        image.info['transparency'] = 0
+    elif mode != 'RGB':
+        image = image.convert(mode)
+    return image
+
+
+def make_corpus():
+    """
+    Return a list of ``(name, data)`` for every source size and type.
+    """
+    corpus = []
+    for width, height in SOURCE_SIZES:
+        for format, mode in SOURCE_TYPES:
+            image = make_image((width, height), mode, seed=width)
+            options = {}
+            if 'transparency' in image.info:
+                options['transparency'] = image.info['transparency']
+            data = StringIO()
+            image.save(data, format, **options)
+            name = '%sx%s_%s.%s' % (width, height, mode.lower(),
+                                    format.lower().replace('jpeg', 'jpg'))
+            corpus.append((name, data.getvalue()))
+    return corpus
+
+
+def get_storages(location, latency):
+    return [
+        ('local', FileSystemStorage(location=location)),
+        ('memory', MemoryStorage(latency=latency)),
+        ('memory-ranges', RangeMemoryStorage(latency=latency)),
+    ]
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps files in a dict and sleeps for ``latency`` seconds on every call
+    to behave a little like a storage on the other end of a network. Like
+    most remote storages it has no ``path()``.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.files = {}
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, name):
+        self._wait()
+        try:
+            return self.files[name]
+        except KeyError:
+            raise IOError('No such file: %s' % name)
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(self._get(name)[0])
+
+    def _save(self, name, content):
+        self._wait()
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        self.files[name] = (content.read(), time.time())
+        return name
+
+    def exists(self, name):
+        self._wait()
+        return name in self.files
+
+    def delete(self, name):
+        self._wait()
+        self.files.pop(name, None)
+
+    def size(self, name):
+        return len(self._get(name)[0])
+
+    def modified_time(self, name):
+        return datetime.fromtimestamp(self._get(name)[1])
+
+    def listdir(self, path):
+        self._wait()
+        return [], [os.path.basename(n) for n in self.files
+                    if os.path.dirname(n) == path]
+
+    def modified_times(self, path):
+        return dict([
+            (name, datetime.fromtimestamp(
+                self.files[os.path.join(path, name)][1]
+            ))
+            for name in self.listdir(path)[1]
+        ])
+
+    def url(self, name):
+        return name
+
+
+class RangeMemoryStorage(MemoryStorage):
+    """
+    A ``MemoryStorage`` that can read part of a file, like storages that
+    support HTTP range requests.
+    """
+
+    def read_range(self, name, start, end):
+        return self._get(name)[0][start:end]
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of the process in kilobytes, or
+    ``None`` where it can't be found.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_stages(storage, source, width, height, proc, resample='quality'):
+    """
+    Generate a single thumbnail from scratch with ``Thumbnail`` and return how
+    long it took along with how long each stage took, as reported by the
+    ``thumbnail_checked`` and ``thumbnail_generated`` signals.
+    """
+    # main can't be imported until settings have been configured.
+    from cuddlybuddly.thumbnail.freshness import invalidate
+    from cuddlybuddly.thumbnail.main import Thumbnail
+    from cuddlybuddly.thumbnail.signals import thumbnail_checked, \
+        thumbnail_generated
+
+    timings = dict([(stage, 0) for stage in STAGES])
+    thumb = Thumbnail(source, width, height, proc=proc, resample=resample,
+                      source_storage=storage, dest_storage=storage,
+                      generate=False)
+    def checked(thumbnail, duration, **kwargs):
+        if thumbnail is thumb:
+            timings['check'] += duration
+    def generated(thumbnail, **kwargs):
+        if thumbnail is thumb:
+            timings.update(kwargs['timings'])
+    def forget():
+        dest = unicode(thumb.dest)
+        if storage.exists(dest):
+            storage.delete(dest)
+        if thumb.metadata is not None:
+            thumb.metadata.delete(thumb._get_metadata_keys()[1])
+        invalidate(source)
+    # Otherwise an earlier run would leave it looking fresh.
+    forget()
+    thumbnail_checked.connect(checked, weak=False)
+    thumbnail_generated.connect(generated, weak=False)
+    try:
+        start = time.time()
+        thumb.generate()
+        timings['total'] = time.time() - start
+    finally:
+        thumbnail_checked.disconnect(checked)
+        thumbnail_generated.disconnect(generated)
+    forget()
+    return timings
+
+
+def run(repeat=3, latency=0.005, processors=None, resamples=None,
+        verbose=True):
+    """
+    Run the benchmark and return its results as a dict.
+    """
+    if processors is None:
+        processors = sorted(PROCESSORS.keys())
+    if resamples is None:
+        resamples = ['quality']
+    corpus = make_corpus()
+    location = tempfile.mkdtemp()
+    results = []
+    throughput = {}
+    try:
+        for storage_name, storage in get_storages(location, latency):
+            for name, data in corpus:
+                storage.save(name, ContentFile(data))
+            generated = 0
+            pixels = 0
+            elapsed = 0.0
+            for name, data in corpus:
+                source_size = Image.open(StringIO(data)).size
+                for proc in processors:
+                    for resample in resamples:
+                        for width, height in THUMBNAIL_SIZES:
+                            runs = [time_stages(storage, name, width, height,
+                                                proc, resample)
+                                    for i in range(repeat)]
+                            timings = dict([
+                                (stage, median([r[stage] for r in runs]))
+                                for stage in STAGES + ('total',)
+                            ])
+                            results.append({
+                                'storage': storage_name,
+                                'source': name,
+                                'processor': proc,
+                                'resample': resample,
+                                'size': [width, height],
+                                'stages': timings,
+                            })
+                            generated += repeat
+                            pixels += source_size[0] * source_size[1] * repeat
+                            elapsed += sum([r['total'] for r in runs])
+                            if verbose:
+                                sys.stdout.write(
+                                    '%s %s %s %s %sx%s: %.1fms\n' % (
+                                        storage_name, name, proc, resample,
+                                        width, height, timings['total'] * 1000
+                                    )
+                                )
+            throughput[storage_name] = {
+                'thumbnails_per_second': generated / elapsed,
+                'megapixels_per_second': pixels / elapsed / 1000000,
+            }
+    finally:
+        shutil.rmtree(location, ignore_errors=True)
+
+    results = {
+        'python': platform.python_version(),
+        'pil': getattr(Image, 'PILLOW_VERSION',
+                       getattr(Image, 'VERSION', None)),
+        'repeat': repeat,
+        'latency': latency,
+        'throughput': throughput,
+        'results': results,
+    }
+    # The peak only ever grows over the process, so it can't be told apart
+    # for each case and is reported for the whole run.
+    if peak_rss() is not None:
+        results['peak_rss'] = peak_rss()
+    return results
+
+
+def compare(baseline, current, threshold=1.1):
+    """
+    Return a list of lines describing how each case in ``current`` compares
+    with the same case in ``baseline``, along with whether any case got
+    slower by more than ``threshold`` times. The stages that got slower are
+    listed but only the total counts as a regression since the shorter
+    stages are too noisy.
+    """
+    def key(result):
+        return (result['storage'], result['source'], result['processor'],
+                result.get('resample', 'quality'), tuple(result['size']))
+    before = dict([(key(r), r) for r in baseline['results']])
+    lines = []
+    regressed = False
+    for result in current['results']:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        slower = []
+        for stage in STAGES + ('total',):
+            if not old['stages'].get(stage):
+                continue
+            ratio = result['stages'][stage] / old['stages'][stage]
+            if ratio > threshold:
+                slower.append('%s %.2fx' % (stage, ratio))
+        ratio = result['stages']['total'] / old['stages']['total']
+        line = '%s %s %s %s %sx%s: %.2fx' % (key(result)[:4] + tuple(
+            result['size']) + (ratio,))
+        if slower:
+            line += ' (slower: %s)' % ', '.join(slower)
+        if ratio > threshold:
+            regressed = True
+        lines.append(line)
+    for storage, values in current['throughput'].items():
+        old = baseline['throughput'].get(storage)
+        if old:
+            lines.append('%s throughput: %.2fx' % (
+                storage, values['thumbnails_per_second'] /
+                old['thumbnails_per_second']
+            ))
+    if 'peak_rss' in current and 'peak_rss' in baseline:
+        lines.append('peak RSS: %skB, was %skB' % (current['peak_rss'],
+                                                  baseline['peak_rss']))
+    return lines, regressed
+
+
+def configure():
+    """
+    Configure just enough settings to run without a project.
+    """
+    from django.conf import settings
+    if settings.configured or os.environ.get('DJANGO_SETTINGS_MODULE'):
+        return
+    settings.configure(
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }},
+        INSTALLED_APPS=['cuddlybuddly.thumbnail'],
+        MEDIA_ROOT=tempfile.gettempdir(),
+        MEDIA_URL='/media/',
+    )
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='How many times to time each case.')
+    parser.add_option('-l', '--latency', type='float', default=0.005,
+                      help='Seconds the in-memory storage waits on each call.')
+    parser.add_option('-p', '--processor', action='append', dest='processors',
+                      help='Only benchmark this processor. Can be given more '
+                           'than once.')
+    parser.add_option('-s', '--resample', action='append', dest='resamples',
+                      choices=sorted(RESAMPLE.keys()),
+                      help='Resample this way, which defaults to quality. '
+                           'Can be given more than once to compare them.')
+    parser.add_option('-o', '--output',
+                      help='Write the results as JSON to this file.')
+    parser.add_option('-c', '--compare',
+                      help='Compare the results with those in this file.')
+    parser.add_option('-t', '--threshold', type='float', default=1.1,
+                      help='How many times slower a stage must be to count '
+                           'as a regression.')
+    parser.add_option('-q', '--quiet', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+
+    configure()
+    results = run(options.repeat, options.latency, options.processors,
+                  options.resamples, not options.quiet)
+    for storage, values in sorted(results['throughput'].items()):
+        sys.stdout.write('%s: %.1f thumbnails/s, %.1f megapixels/s\n' % (
+            storage, values['thumbnails_per_second'],
+            values['megapixels_per_second']
+        ))
+    if 'peak_rss' in results:
+        sys.stdout.write('peak RSS: %skB\n' % results['peak_rss'])
+    if options.output:
+        file = open(options.output, 'w')
+        try:
+            json.dump(results, file, indent=2, sort_keys=True)
+        finally:
+            file.close()
+    if options.compare:
+        file = open(options.compare, 'r')
+        try:
+            baseline = json.load(file)
+        finally:
+            file.close()
+        lines, regressed = compare(baseline, results, options.threshold)
+        sys.stdout.write('\n'.join(lines) + '\n')
+        if regressed:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
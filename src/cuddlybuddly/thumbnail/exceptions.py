@@ -1,2 +1,10 @@
 class ThumbnailException(Exception):
     silent_variable_failure = True
+
+
+class ExecutorFull(ThumbnailException):
+    """
+    An executor already had as many jobs as it takes and was asked not to
+    wait for room for another.
+    """
+    pass
@@ -0,0 +1,268 @@
+import logging
+import multiprocessing
+import threading
+from multiprocessing.pool import Pool, ThreadPool
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+from cuddlybuddly.thumbnail.exceptions import ExecutorFull
+
+
+logger = logging.getLogger('cuddlybuddly.thumbnail')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _call(func, args):
+    """
+    Run ``func`` and return any exception it raises along with its result,
+    as pools in Python 2 only call back for jobs that succeed.
+    """
+    try:
+        return None, func(*args)
+    except Exception, e:
+        return e, None
+
+
+class Future(object):
+    """
+    The eventual result of a job given to an executor, with the same
+    ``done()``, ``result()`` and ``add_done_callback()`` as
+    ``concurrent.futures``.
+    """
+
+    def __init__(self, result, callback=None):
+        self._result = result
+        self._callback = callback
+        self._finished = False
+        self._value = None
+        self._notified = False
+        self._done_callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._result.ready()
+
+    def result(self, timeout=None):
+        """
+        Wait up to ``timeout`` seconds, or for as long as it takes, for the
+        job to finish and return its result or raise its exception.
+        ``multiprocessing.TimeoutError`` is raised if it doesn't finish in
+        time.
+        """
+        if not self._finished:
+            error, value = self._result.get(timeout)
+            if error is not None:
+                raise error
+            if self._callback is not None:
+                value = self._callback(value)
+            self._value = value
+            self._finished = True
+        return self._value
+
+    def add_done_callback(self, fn):
+        """
+        Call ``fn(future)`` once the job is done, or straight away if it
+        already is. It's called in whichever thread finished the job, so an
+        event loop should hand it over to its own thread, such as with
+        Tornado's ``IOLoop.add_callback()`` or Twisted's
+        ``reactor.callFromThread()``, rather than block waiting on
+        ``result()``.
+        """
+        self._lock.acquire()
+        try:
+            if not self._notified:
+                self._done_callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        self._call_back(fn)
+
+    def _notify(self):
+        self._lock.acquire()
+        try:
+            self._notified = True
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            self._call_back(fn)
+
+    def _call_back(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logger.exception('Failed to call back for a thumbnail')
+
+
+class _FinishedResult(object):
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        return self.value
+
+
+class BaseExecutor(object):
+    """
+    Runs the work of generating thumbnails somewhere other than the thread
+    asking for them. Executors that run it in other processes set ``remote``
+    and are only given jobs that can be pickled, while any others go to the
+    executor in ``local`` or are run in the calling thread without one.
+    """
+
+    remote = False
+    local = None
+
+    def submit(self, func, args=(), callback=None, block=True):
+        """
+        Run ``func(*args)`` and return a ``Future`` for it. ``callback`` is
+        given the result in the thread that asks for it and returns what
+        ``result()`` should. Executors that can't take on another job yet
+        wait for room unless ``block`` is false, in which case the future
+        raises ``ExecutorFull``.
+        """
+        raise NotImplementedError()
+
+    def shutdown(self):
+        """
+        Wait for everything submitted so far and stop any workers.
+        """
+        pass
+
+
+class SerialExecutor(BaseExecutor):
+    """
+    Runs jobs straight away in the calling thread, as ``Thumbnail`` always
+    has.
+    """
+
+    def submit(self, func, args=(), callback=None, block=True):
+        future = Future(_FinishedResult(_call(func, args)), callback)
+        future._notify()
+        return future
+
+
+class PoolExecutor(BaseExecutor):
+    """
+    Runs jobs in a pool of ``workers``, which is started when the first job
+    is submitted. No more than ``max_pending`` jobs are waiting or running at
+    once and ``submit()`` blocks until there's room for more, so a bulk job
+    can't queue up more work than the workers can get through. Given
+    ``block=False`` it gives back a future that fails with ``ExecutorFull``
+    instead.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        if workers is None:
+            workers = getattr(settings,
+                              'CUDDLYBUDDLY_THUMBNAIL_EXECUTOR_WORKERS', None)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = int(workers)
+        if max_pending is None:
+            max_pending = getattr(
+                settings, 'CUDDLYBUDDLY_THUMBNAIL_EXECUTOR_MAX_PENDING',
+                self.workers * 4
+            )
+        self.max_pending = int(max_pending)
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def _make_pool(self):
+        raise NotImplementedError()
+
+    def _get_pool(self):
+        self.lock.acquire()
+        try:
+            if self.pool is None:
+                self.pool = self._make_pool()
+            return self.pool
+        finally:
+            self.lock.release()
+
+    def submit(self, func, args=(), callback=None, block=True):
+        if not self.slots.acquire(block):
+            future = Future(_FinishedResult((ExecutorFull(
+                '%s thumbnails are already being generated.' % self.max_pending
+            ), None)))
+            future._notify()
+            return future
+        future = Future(None, callback)
+        def finished(value):
+            self.slots.release()
+            future._notify()
+        # Held until the result is set in case the job finishes first.
+        future._lock.acquire()
+        try:
+            future._result = self._get_pool().apply_async(
+                _call, (func, args), callback=finished
+            )
+        except:
+            self.slots.release()
+            raise
+        finally:
+            future._lock.release()
+        return future
+
+    def shutdown(self):
+        self.lock.acquire()
+        try:
+            pool, self.pool = self.pool, None
+        finally:
+            self.lock.release()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+class ThreadExecutor(PoolExecutor):
+    """
+    Runs jobs in threads in the current process. PIL lets go of the GIL while
+    it decodes, resizes and encodes, and storages while they wait on the
+    network, so this is enough to keep several cores busy.
+    """
+
+    def _make_pool(self):
+        return ThreadPool(self.workers)
+
+
+class ProcessExecutor(PoolExecutor):
+    """
+    Runs jobs in forked processes, for processors that spend their time in
+    Python rather than PIL. Only thumbnails of sources given as a path, with
+    storages given as dotted paths or left to the settings, can be sent to
+    another process and any others are generated by threads in ``local``.
+    """
+
+    remote = True
+
+    def __init__(self, workers=None, max_pending=None):
+        super(ProcessExecutor, self).__init__(workers, max_pending)
+        self.local = ThreadExecutor(self.workers, self.max_pending)
+
+    def _make_pool(self):
+        return Pool(self.workers)
+
+    def shutdown(self):
+        super(ProcessExecutor, self).shutdown()
+        self.local.shutdown()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor_lock.acquire()
+        try:
+            if _executor is None:
+                _executor = get_callable(getattr(
+                    settings, 'CUDDLYBUDDLY_THUMBNAIL_EXECUTOR',
+                    'cuddlybuddly.thumbnail.executors.ThreadExecutor'
+                ))()
+        finally:
+            _executor_lock.release()
+    return _executor
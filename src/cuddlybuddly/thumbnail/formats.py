@@ -0,0 +1,69 @@
+import mimetypes
+import os
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+from django.conf import settings
+
+
+# The formats offered to browsers that say they accept them, best first.
+NEGOTIATED_FORMATS = ('AVIF', 'WEBP')
+
+
+def can_save(format):
+    """
+    Return whether the installed PIL can save images as ``format``. AVIF
+    needs a recent Pillow or the pillow-avif-plugin.
+    """
+    Image.init()
+    return format.upper() in Image.SAVE
+
+
+def get_extension(format):
+    Image.init()
+    format = format.upper()
+    extensions = sorted([ext for ext, f in Image.EXTENSION.items()
+                         if f == format])
+    if '.%s' % format.lower() in extensions:
+        return '.%s' % format.lower()
+    if extensions:
+        return extensions[0]
+    return '.%s' % format.lower()
+
+
+def get_mime_type(filename):
+    mime_type = mimetypes.guess_type(filename)[0]
+    if mime_type is None:
+        Image.init()
+        format = Image.EXTENSION.get(os.path.splitext(filename)[1].lower())
+        mime_type = Image.MIME.get(format, 'application/octet-stream')
+    return mime_type
+
+
+def choose_format(accept, formats=None):
+    """
+    Return the first of ``formats`` that the ``Accept`` header says is
+    acceptable and PIL can save, or None if there isn't one. Defaults to
+    ``CUDDLYBUDDLY_THUMBNAIL_FORMATS``.
+    """
+    if formats is None:
+        formats = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_FORMATS',
+                          NEGOTIATED_FORMATS)
+    accepted = set()
+    for media_range in accept.split(','):
+        params = media_range.strip().split(';')
+        refused = False
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    refused = float(value) <= 0
+                except ValueError:
+                    pass
+        if not refused:
+            accepted.add(params[0].strip().lower())
+    for format in formats:
+        if 'image/%s' % format.lower() in accepted and can_save(format):
+            return format.upper()
+    return None
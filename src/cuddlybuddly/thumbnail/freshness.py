@@ -0,0 +1,182 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.encoding import force_unicode, smart_str
+from cuddlybuddly.thumbnail.spec import serialize
+try:
+    from django.core.cache import caches
+except ImportError:
+    caches = None
+    from django.core.cache import get_cache
+
+
+ALL_KEY = 'cuddlybuddly.thumbnail.fresh'
+
+_freshness_cache = None
+_freshness_lock = threading.Lock()
+
+
+def make_key(source, dest, width, height, processor):
+    """
+    Build the key used to remember that the thumbnail of ``source`` saved to
+    ``dest`` with ``processor`` and its options doesn't need regenerating.
+    """
+    return hashlib.md5(smart_str(u'\0'.join([
+        force_unicode(source), force_unicode(dest),
+        force_unicode(serialize(processor, width, height))
+    ]))).hexdigest()
+
+
+class FreshnessCache(object):
+    """
+    Remembers which thumbnails were recently found to be up to date so that
+    rendering them again doesn't have to ask the storage for modification
+    times.
+
+    There are two layers. An LRU inside each process which can only be
+    invalidated for the current process and so relies on its TTL for changes
+    made elsewhere, and an optional shared layer in one of Django's caches
+    which is invalidated for everyone.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.backends = {}
+
+    def _get_ttl(self):
+        return getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_TTL', 0)
+    ttl = property(_get_ttl)
+
+    def _get_backend(self):
+        alias = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_CACHE',
+                        None)
+        if alias is None:
+            return None
+        if alias not in self.backends:
+            if caches is not None:
+                self.backends[alias] = caches[alias]
+            else:
+                self.backends[alias] = get_cache(alias)
+        return self.backends[alias]
+    backend = property(_get_backend)
+
+    def _source_key(self, source):
+        return 'cuddlybuddly.thumbnail.source.%s' % hashlib.md5(
+            smart_str(force_unicode(source))
+        ).hexdigest()
+
+    def _entry_key(self, key):
+        return 'cuddlybuddly.thumbnail.fresh.%s' % key
+
+    def is_fresh(self, key, source):
+        return key in self.find_fresh([(key, source)])
+
+    def find_fresh(self, items):
+        """
+        Return the set of keys that are fresh out of ``items``, a list of keys
+        and their sources, asking the shared layer about all of them at once.
+        """
+        fresh = set()
+        if not self.ttl:
+            return fresh
+        now = time.time()
+        unknown = []
+        self.lock.acquire()
+        try:
+            for key, source in items:
+                entry = self.entries.pop(key, None)
+                if entry is not None and entry[0] > now:
+                    self.entries[key] = entry
+                    fresh.add(key)
+                else:
+                    unknown.append((key, source))
+        finally:
+            self.lock.release()
+
+        backend = self.backend
+        if backend is None or not unknown:
+            return fresh
+        keys = set([ALL_KEY])
+        for key, source in unknown:
+            keys.add(self._source_key(source))
+            keys.add(self._entry_key(key))
+        values = backend.get_many(list(keys))
+        for key, source in unknown:
+            entry_key = self._entry_key(key)
+            if entry_key in values and \
+               values[entry_key] == self._version(values, source):
+                self._remember(key, source, now)
+                fresh.add(key)
+        return fresh
+
+    def mark_fresh(self, key, source):
+        ttl = self.ttl
+        if not ttl:
+            return
+        self._remember(key, source, time.time())
+        backend = self.backend
+        if backend is not None:
+            values = backend.get_many([ALL_KEY, self._source_key(source)])
+            backend.set(self._entry_key(key), self._version(values, source),
+                        ttl)
+
+    def _version(self, values, source):
+        return (values.get(ALL_KEY, 0),
+                values.get(self._source_key(source), 0))
+
+    def _remember(self, key, source, now):
+        size = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_SIZE', 1000)
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + self.ttl, force_unicode(source))
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, source=None):
+        """
+        Forget everything remembered about thumbnails of ``source``, or about
+        every thumbnail if no source is given.
+        """
+        self.lock.acquire()
+        try:
+            if source is None:
+                self.entries.clear()
+            else:
+                source = force_unicode(source)
+                for key, entry in self.entries.items():
+                    if entry[1] == source:
+                        del self.entries[key]
+        finally:
+            self.lock.release()
+
+        backend = self.backend
+        if backend is not None:
+            # Bumping a version makes the shared entries look stale without
+            # having to know what they were called.
+            if source is None:
+                key = ALL_KEY
+            else:
+                key = self._source_key(source)
+            backend.set(key, time.time(), self.ttl)
+
+
+def get_freshness_cache():
+    global _freshness_cache
+    if _freshness_cache is None:
+        _freshness_lock.acquire()
+        try:
+            if _freshness_cache is None:
+                _freshness_cache = FreshnessCache()
+        finally:
+            _freshness_lock.release()
+    return _freshness_cache
+
+
+def invalidate(source=None):
+    get_freshness_cache().invalidate(source)
@@ -1,20 +1,19 @@
 import hashlib
-import os
-from django.conf import settings
 from django.db.models.fields.files import FieldFile
-from django.utils.encoding import force_unicode
+from django.utils.encoding import force_unicode, smart_str
+from cuddlybuddly.thumbnail.freshness import invalidate
+from cuddlybuddly.thumbnail.metadata import get_backend
 
 
 def update_cache(sender, instance, **kwargs):
+    keys = []
     for field in instance.__dict__.keys():
         field = getattr(instance, field)
         if isinstance(field, FieldFile):
-            cache_dir = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_CACHE', None)
             field = force_unicode(field)
-            if field and cache_dir is not None:
-                cache = os.path.join(
-                    cache_dir,
-                    hashlib.md5(field).hexdigest()
-                )
-                if os.path.exists(cache):
-                    os.remove(cache)
+            if field:
+                invalidate(field)
+                keys.append(hashlib.md5(smart_str(field)).hexdigest())
+    backend = get_backend()
+    if keys and backend is not None:
+        backend.delete_many(keys)
@@ -0,0 +1,274 @@
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import uuid
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import get_callable
+from django.utils.encoding import force_unicode, smart_str
+try:
+    from django.core.cache import caches
+except ImportError:
+    caches = None
+    from django.core.cache import get_cache
+
+
+# How often to try a lock held by another process again while waiting for it.
+POLL_INTERVAL = 0.05
+
+_entries = {}
+_entries_lock = threading.Lock()
+_caches = {}
+
+
+class BaseLockBackend(object):
+    """
+    Somewhere to take locks that are shared between processes so that only
+    one of them generates each thumbnail at a time.
+    """
+
+    def acquire(self, key, timeout):
+        """
+        Try to take the lock for ``key`` without waiting for it. Returns a
+        token to be given to ``release()`` if it was taken, otherwise None.
+        Locks that are never released should be given up after ``timeout``
+        seconds.
+        """
+        raise NotImplementedError()
+
+    def release(self, key, token):
+        raise NotImplementedError()
+
+
+class FileLockBackend(BaseLockBackend):
+    """
+    Takes locks with ``flock()`` on files in
+    ``CUDDLYBUDDLY_THUMBNAIL_LOCK_DIR`` so it only works between processes on
+    the same machine, but locks are always given up when a process dies. Each
+    key has its own file, in a directory named after the key's first two
+    characters, which is deleted again when the lock is released.
+    """
+
+    def __init__(self, location=None):
+        if fcntl is None:
+            raise ImproperlyConfigured('FileLockBackend needs fcntl, which '
+                                       'isn\'t available on this platform.')
+        if location is None:
+            location = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_LOCK_DIR',
+                               None)
+        if location is None:
+            location = os.path.join(tempfile.gettempdir(),
+                                    'cuddlybuddly-thumbnail-locks')
+        self.location = location
+
+    def _get_path(self, key):
+        return os.path.join(self.location, key[:2], 'lock-%s' % key)
+
+    def acquire(self, key, timeout):
+        path = self._get_path(key)
+        directory = os.path.dirname(path)
+        while True:
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            fd = os.open(path, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return None
+            # Whoever held it before may have deleted the file before this
+            # one was locked, in which case the lock is on a file nobody
+            # else will find.
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            os.close(fd)
+
+    def release(self, key, token):
+        try:
+            # Deleted while still locked so that nobody can lock it and then
+            # find it gone.
+            os.remove(self._get_path(key))
+        except OSError:
+            pass
+        try:
+            fcntl.flock(token, fcntl.LOCK_UN)
+        finally:
+            os.close(token)
+
+
+class CacheLockBackend(BaseLockBackend):
+    """
+    Takes locks as leases in one of Django's caches, named by
+    ``CUDDLYBUDDLY_THUMBNAIL_LOCK_CACHE``. The cache must be shared by every
+    process, so not ``locmem``, and support an atomic ``add()``, which
+    memcached and redis do.
+    """
+
+    prefix = 'cuddlybuddly.thumbnail.lock.'
+
+    def __init__(self, alias=None):
+        if alias is None:
+            alias = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_LOCK_CACHE',
+                            'default')
+        if alias not in _caches:
+            if caches is not None:
+                _caches[alias] = caches[alias]
+            else:
+                _caches[alias] = get_cache(alias)
+        self.cache = _caches[alias]
+
+    def acquire(self, key, timeout):
+        token = uuid.uuid4().hex
+        if self.cache.add(self.prefix + key, token, timeout):
+            return token
+        return None
+
+    def release(self, key, token):
+        # Only give up the lease if it hasn't expired and been taken by
+        # someone else in the meantime.
+        if self.cache.get(self.prefix + key) == token:
+            self.cache.delete(self.prefix + key)
+
+
+class _Entry(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.held = False
+        self.users = 0
+
+
+class Lock(object):
+    """
+    A lock taken by ``acquire()``. ``waited`` is whether it had to wait for
+    someone else to give it up first, in which case they may well have done
+    whatever the lock was for already.
+    """
+
+    def __init__(self, key, entry, backend, token, waited):
+        self.key = key
+        self.entry = entry
+        self.backend = backend
+        self.token = token
+        self.waited = waited
+
+    def release(self):
+        try:
+            if self.backend is not None:
+                self.backend.release(self.key, self.token)
+        finally:
+            _release_entry(self.key, self.entry)
+
+
+def _get_entry(key):
+    _entries_lock.acquire()
+    try:
+        entry = _entries.get(key)
+        if entry is None:
+            entry = _entries[key] = _Entry()
+        entry.users += 1
+        return entry
+    finally:
+        _entries_lock.release()
+
+
+def _put_entry(key, entry):
+    _entries_lock.acquire()
+    try:
+        entry.users -= 1
+        if not entry.users:
+            del _entries[key]
+    finally:
+        _entries_lock.release()
+
+
+def _release_entry(key, entry):
+    entry.condition.acquire()
+    try:
+        entry.held = False
+        entry.condition.notify()
+    finally:
+        entry.condition.release()
+    _put_entry(key, entry)
+
+
+def get_backend():
+    """
+    Return the configured lock backend or None if locks are only taken within
+    the current process.
+    """
+    backend = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_LOCK_BACKEND', None)
+    if backend is None:
+        return None
+    return get_callable(backend)()
+
+
+def acquire(name, wait=None):
+    """
+    Take the lock for ``name``, waiting up to ``wait`` seconds for anyone else
+    holding it. Returns a ``Lock`` to be released once done or None if it
+    couldn't be taken in time.
+
+    Threads in the same process wait on each other without going anywhere near
+    the lock backend, which is only used to wait on other processes.
+    """
+    if wait is None:
+        wait = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_LOCK_WAIT', 10)
+    timeout = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_LOCK_TIMEOUT', 60)
+    deadline = time.time() + wait
+    key = hashlib.md5(smart_str(force_unicode(name))).hexdigest()
+    waited = False
+
+    entry = _get_entry(key)
+    entry.condition.acquire()
+    try:
+        while entry.held:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            waited = True
+            entry.condition.wait(remaining)
+        acquired = not entry.held
+        if acquired:
+            entry.held = True
+    finally:
+        entry.condition.release()
+    if not acquired:
+        _put_entry(key, entry)
+        return None
+
+    try:
+        backend = get_backend()
+        token = None
+        if backend is not None:
+            while True:
+                token = backend.acquire(key, timeout)
+                if token is not None:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    _release_entry(key, entry)
+                    return None
+                waited = True
+                time.sleep(min(POLL_INTERVAL, remaining))
+    except:
+        _release_entry(key, entry)
+        raise
+    return Lock(key, entry, backend, token, waited)
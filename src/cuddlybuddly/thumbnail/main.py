@@ -1,27 +1,71 @@
 import hashlib
 import os
-import pickle
+import threading
+import time
 try:
     from PIL import Image
 except ImportError:
     import Image
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 from django.conf import settings
 from django.core.files.base import ContentFile, File
-from django.core.files.storage import default_storage
 from django.db.models.fields.files import FieldFile
 from django.utils.encoding import force_unicode, smart_str
 from cuddlybuddly.thumbnail import get_processor
+from cuddlybuddly.thumbnail.background import get_queue
 from cuddlybuddly.thumbnail.exceptions import ThumbnailException
+from cuddlybuddly.thumbnail.executors import get_executor, SerialExecutor, \
+    ThreadExecutor
+from cuddlybuddly.thumbnail.formats import can_save, get_extension
+from cuddlybuddly.thumbnail.freshness import get_freshness_cache, \
+    make_key as make_freshness_key
+from cuddlybuddly.thumbnail.locks import acquire as acquire_lock
+from cuddlybuddly.thumbnail.metadata import get_backend as \
+    get_metadata_backend
+from cuddlybuddly.thumbnail.probe import probe
+from cuddlybuddly.thumbnail.processors import ORIGINAL_SIZE, RESAMPLE
+from cuddlybuddly.thumbnail.spec import get_extra_options, \
+    get_key as get_spec_key
+from cuddlybuddly.thumbnail.signals import thumbnail_checked, \
+    thumbnail_generated
+from cuddlybuddly.thumbnail.sourcecache import get_source_cache
+from cuddlybuddly.thumbnail.storage import get_dest_storage, \
+    get_modified_times, get_source_storage, open_source, save_overwrite
+
+
+# Buffers that have grown larger than this aren't kept for reuse.
+MAX_BUFFER_SIZE = 4 * 2**20
+
+_buffers = threading.local()
 
 
 def build_thumbnail_name(source, width, height, processor):
     source = force_unicode(source)
     path, filename = os.path.split(source)
     filename = processor.generate_filename(filename, width, height)
+    if processor.format:
+        # Kept next to the thumbnails in other formats.
+        filename = os.path.splitext(filename)[0] + \
+                   get_extension(processor.format)
+    extra = get_extra_options(processor)
+    if extra:
+        basename, ext = os.path.splitext(filename)
+        filename = '%s_%s%s' % (basename, get_spec_key(processor, width,
+                                                       height, extra), ext)
     return os.path.join(
         getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_BASEDIR', ''),
         path,
@@ -30,154 +74,970 @@ def build_thumbnail_name(source, width, height, processor):
     )
 
 
+def draft(image, decode_size):
+    """
+    Have PIL decode the image at no smaller than ``decode_size``, keeping its
+    real size in ``image.info`` if that makes it any smaller.
+    """
+    if decode_size is not None:
+        size = image.size
+        image.draft(image.mode, decode_size)
+        if image.size != size:
+            image.info[ORIGINAL_SIZE] = size
+
+
+def lap(timings, stage, start):
+    """
+    Record how long ``stage`` took since ``start`` in ``timings`` and return
+    the time it finished, or do nothing if timings aren't being kept.
+    """
+    if timings is None:
+        return None
+    now = time.time()
+    timings[stage] = timings.get(stage, 0) + now - start
+    return now
+
+
+def get_buffer():
+    """
+    Return an empty buffer to encode thumbnails into. Each thread reuses the
+    same buffer so the memory it has grown to isn't allocated over and over
+    again, unless it has been closed by a storage or grown unusually large.
+    """
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or buffer.closed or \
+       buffer.tell() > MAX_BUFFER_SIZE:
+        buffer = _buffers.buffer = StringIO()
+    buffer.seek(0)
+    buffer.truncate()
+    return buffer
+
+
+def hash_file(file, chunk_size=64 * 2**10):
+    """
+    Hash the entire contents of a file like object a chunk at a time so that it
+    never has to be held in memory, leaving the file where it was found. The
+    fastest available digest is used and its name is included in the result.
+    """
+    if xxhash is not None:
+        name, digest = 'xxh64', xxhash.xxh64()
+    elif blake2b is not None:
+        name, digest = 'blake2b', blake2b(digest_size=16)
+    else:
+        name, digest = 'md5', hashlib.md5()
+    position = None
+    if hasattr(file, 'seek'):
+        position = file.tell()
+        file.seek(0)
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    if position is not None:
+        file.seek(position)
+    return '%s:%s' % (name, digest.hexdigest())
+
+
 class Thumbnail(object):
+    """
+    A thumbnail of ``source`` that is generated straight away if it's stale,
+    or left until it's needed with ``lazy=True``.
+
+    Creating a lazy thumbnail doesn't touch the storages, build the processor
+    or even check its options, so they can be made in bulk for nothing. Its
+    name is worked out when it's first asked for, ``exists`` only asks the
+    storage and ``dimensions`` only reads the source's header, while ``url``
+    and ``path`` generate it first if it's stale. Each is only worked out
+    once.
+    """
+
     def __init__(self, source, width, height, dest=None, proc=None, *args,
                  **kwargs):
         self.source = source
         self.width = width
         self.height = height
-        self.processor = get_processor(proc)(*args, **kwargs)
-        if dest is None:
-            dest = build_thumbnail_name(source, width, height, self.processor)
-        self.dest = dest
-        self.cache_dir = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_CACHE', None)
+        self.background = kwargs.pop('background', getattr(
+            settings, 'CUDDLYBUDDLY_THUMBNAIL_BACKGROUND', False
+        ))
+        self.content_key = kwargs.pop('content_key', None)
+        source_storage = kwargs.pop('source_storage', None)
+        dest_storage = kwargs.pop('dest_storage', None)
+        # Kept as given for rebuilding the thumbnail in another process.
+        self._storages = (source_storage, dest_storage)
+        if source_storage is None and isinstance(source, FieldFile):
+            source_storage = source.storage
+        self.source_storage = get_source_storage(source_storage)
+        self.dest_storage = get_dest_storage(dest_storage)
+        self.pending = False
+        self.generated = False
+        self._source_key = None
+        self._dest_key = None
+        self._freshness_key = None
+        self._dimensions = None
+        self._url = None
+        self._exists = None
+        self._ensured = False
+        self.lazy = kwargs.pop('lazy', False)
+        generate = kwargs.pop('generate', True)
+        if kwargs.get('format') == 'auto':
+            # Only a view that can see the Accept header can choose one.
+            del kwargs['format']
+        self._proc = proc
+        self._args = args
+        self._kwargs = kwargs
+        self._processor = None
+        self._dest = dest
+        self._metadata = None
+        self._metadata_loaded = False
 
         for var in ('width', 'height'):
             try:
                 setattr(self, var, int(getattr(self, var)))
             except ValueError:
                 raise ThumbnailException('Value supplied for \'%s\' is not an int' % var)
-        if self.processor is None:
-            raise ThumbnailException('There is no image processor available')
 
-        self.generate()
+        if not self.lazy:
+            self._get_processor()
+            if generate:
+                self.generate()
 
     def __unicode__(self):
         return force_unicode(self.dest)
 
+    def _get_processor(self):
+        if self._processor is None:
+            processor = get_processor(self._proc)(*self._args, **self._kwargs)
+            if processor is None:
+                raise ThumbnailException('There is no image processor '
+                                         'available')
+            if processor.format and not can_save(processor.format):
+                raise ThumbnailException('Saving as %s is not supported'
+                                         % processor.format)
+            if processor.resample not in RESAMPLE:
+                raise ThumbnailException('Unknown resample value: %s'
+                                         % processor.resample)
+            self._processor = processor
+        return self._processor
+    processor = property(_get_processor)
+
+    def _get_dest(self):
+        if self._dest is None:
+            self._dest = build_thumbnail_name(self.source, self.width,
+                                              self.height, self.processor)
+        return self._dest
+    dest = property(_get_dest)
+
+    def _get_metadata(self):
+        if not self._metadata_loaded:
+            self._metadata = get_metadata_backend()
+            self._metadata_loaded = True
+        return self._metadata
+    metadata = property(_get_metadata)
+
+    def _ensure(self):
+        """
+        Generate a lazy thumbnail the first time something needs it to exist.
+        """
+        if self.lazy and not self._ensured:
+            self.generate()
+
+    def _get_url(self):
+        if self._url is None:
+            self._ensure()
+            self._url = self.dest_storage.url(force_unicode(self.dest))
+        return self._url
+    url = property(_get_url)
+
+    def _get_path(self):
+        """
+        The thumbnail's path on the local disk, which storages without one
+        raise ``NotImplementedError`` for.
+        """
+        self._ensure()
+        return self.dest_storage.path(force_unicode(self.dest))
+    path = property(_get_path)
+
+    def _get_exists(self):
+        """
+        Whether the thumbnail has been saved, which doesn't generate it.
+        """
+        if self._exists is None:
+            self._exists = self.generated or \
+                           self.dest_storage.exists(force_unicode(self.dest))
+        return self._exists
+    exists = property(_get_exists)
+
+    def _get_dimensions(self):
+        """
+        The width and height the thumbnail is, or will be once it's generated,
+        or None if the processor can't tell without generating it. Finding
+        out doesn't generate anything or read more of the source than its
+        header, and with a metadata backend it's only read once.
+
+        ``width`` and ``height`` are the size that was asked for.
+        """
+        if self._dimensions is None:
+            self._dimensions = self._find_dimensions()
+        return self._dimensions
+    dimensions = property(_get_dimensions)
+
+    def _find_dimensions(self):
+        if self.metadata is None or not isinstance(self.dest, basestring):
+            size = probe(self.source, self.source_storage)[:2]
+            return self.processor.get_size(size, self.width, self.height)
+        source, dest = self._get_metadata_keys()
+        # The source's own size is kept apart from its record so that adding
+        # it doesn't look like the source changed.
+        probed = hashlib.md5(source + ':probe').hexdigest()
+        records = self.metadata.get_many([source, dest, probed])
+        if source not in records:
+            records[source] = self.metadata.set(source)
+        mtime = records[source]['mtime']
+        record = records.get(dest)
+        if record is not None and record['width'] is not None and \
+           record['mtime'] >= mtime:
+            return (record['width'], record['height'])
+        record = records.get(probed)
+        if record is None or record['width'] is None or \
+           record['mtime'] < mtime:
+            width, height, format = probe(self.source, self.source_storage)
+            record = self.metadata.set(probed, width=width, height=height,
+                                       format=format)
+        return self.processor.get_size((record['width'], record['height']),
+                                       self.width, self.height)
+
     def generate(self):
+        self._ensured = True
         if hasattr(self.dest, 'write'):
             self._do_generate()
+        elif self.is_stale():
+            self._generate_stale()
+
+    def generate_async(self, executor=None, block=True):
+        """
+        Generate the thumbnail, if it's stale, with ``executor`` rather than
+        in the calling thread and return a future whose ``result()`` is the
+        thumbnail once it's done. Defaults to the executor named by
+        ``CUDDLYBUDDLY_THUMBNAIL_EXECUTOR``. Unless ``block`` is true, the
+        future raises ``ExecutorFull`` when the executor has no room for it.
+        """
+        if executor is None:
+            executor = get_executor()
+        return self._submit(executor, _generate, block)
+
+    def _submit(self, executor, job, block=True):
+        """
+        Give ``job(self)`` to ``executor``, or for executors in other
+        processes have the thumbnail rebuilt and generated there.
+        """
+        self._ensured = True
+        if not executor.remote:
+            return executor.submit(job, (self,), block=block)
+        if not self._can_send():
+            # Nothing else can be pickled, so it's generated here instead.
+            local = executor.local
+            if local is None:
+                local = SerialExecutor()
+            return local.submit(job, (self,), block=block)
+        return executor.submit(generate_remote, (
+            self.source, self.width, self.height, self.dest, self._proc,
+            self._args, dict(self._kwargs, source_storage=self._storages[0],
+                             dest_storage=self._storages[1])
+        ), self._update, block)
+
+    def _can_send(self):
+        return isinstance(self.source, basestring) and \
+               isinstance(self.dest, basestring) and \
+               not [s for s in self._storages
+                    if s is not None and not isinstance(s, basestring)]
+
+    def _update(self, state):
+        """
+        Take on what happened to the thumbnail in another process.
+        """
+        self.generated, self.pending, dimensions = state
+        if dimensions is not None:
+            self._dimensions = dimensions
+        if self.generated:
+            self._exists = True
+        return self
+
+    def _generate_stale(self):
+        """
+        Generate a thumbnail that was found to be stale, or queue it to be
+        generated in the background.
+        """
+        self._ensured = True
+        if self._can_defer():
+            self._claim()
+            self.pending = True
+            get_queue().put(self)
         else:
-            do_generate = False
-            if self.cache_dir is not None:
-                if isinstance(self.source, FieldFile) or \
-                   isinstance(self.source, File):
-                    source = force_unicode(self.source)
-                elif not isinstance(self.source, basestring):
-                    source = pickle.dumps(self.source.read())
-                    self.source.seek(0)
-                else:
-                    source = smart_str(force_unicode(self.source))
-                source = os.path.join(self.cache_dir,
-                                      hashlib.md5(source).hexdigest())
-                if not os.path.exists(source):
-                    path = os.path.split(source)[0]
-                    if not os.path.exists(path):
-                        os.makedirs(path)
-                    open(source, 'w').close()
-                if not isinstance(self.dest, basestring):
-                    dest = pickle.dumps(self.dest.read())
-                    self.dest.seek(0)
-                else:
-                    dest = smart_str(force_unicode(self.dest))
-                dest = os.path.join(self.cache_dir,
-                                      hashlib.md5(dest).hexdigest())
-            else:
-                source = force_unicode(self.source)
-                dest = self.dest
+            self._generate_once()
+
+    def is_stale(self):
+        """
+        Return whether the thumbnail needs generating. Thumbnails that are found
+        to be up to date are remembered as such.
+        """
+        if not thumbnail_checked.receivers:
+            return self._check()[0]
+        start = time.time()
+        stale, checked_by, cache_hit = self._check()
+        thumbnail_checked.send(
+            sender=self.__class__, thumbnail=self, stale=stale,
+            checked_by=checked_by, cache_hit=cache_hit,
+            duration=time.time() - start
+        )
+        return stale
 
-            if hasattr(default_storage, 'modified_time') and not self.cache_dir:
+    def _check(self):
+        """
+        Return whether the thumbnail needs generating along with what
+        answered that and whether it was answered from a cache, which is None
+        if no cache was asked.
+        """
+        if self._make_freshness_key() is not None and \
+           get_freshness_cache().is_fresh(self._freshness_key, self.source):
+            return False, 'freshness', True
+
+        do_generate = False
+        cache_hit = None
+        if self.metadata is not None:
+            checked_by = 'metadata'
+            source = self._get_metadata_keys()[0]
+            records = self.metadata.get_many([source, self._dest_key])
+            if source not in records:
+                records[source] = self.metadata.set(source)
+            cache_hit = self._dest_key in records
+            # A record without dimensions is only a claim, so the thumbnail
+            # is still being generated and has to be waited on through the
+            # lock.
+            do_generate = not cache_hit or \
+                    records[source]['mtime'] > \
+                    records[self._dest_key]['mtime'] or \
+                    records[self._dest_key]['width'] is None
+        elif hasattr(self.source_storage, 'modified_time') and \
+             hasattr(self.dest_storage, 'modified_time'):
+            checked_by = 'storage'
+            source = force_unicode(self.source)
+            try:
+                source_mod_time = self.source_storage.modified_time(source)
+            except EnvironmentError:
+                # Means the source file doesn't exist, so nothing can be
+                # done and it shouldn't be remembered as being fresh.
+                do_generate = False
+                self._freshness_key = None
+            else:
                 try:
-                    source_mod_time = default_storage.modified_time(source)
+                    dest_mod_time = self.dest_storage.modified_time(
+                        self.dest
+                    )
                 except EnvironmentError:
-                    # Means the source file doesn't exist, so nothing can be
-                    # done.
-                    do_generate = False
+                    # Means the destination file doesn't exist so it must be
+                    # generated.
+                    do_generate = True
                 else:
-                    try:
-                        dest_mod_time = default_storage.modified_time(dest)
-                    except EnvironmentError:
-                        # Means the destination file doesn't exist so it must be
-                        # generated.
-                        do_generate = True
-                    else:
-                        do_generate = source_mod_time > dest_mod_time
-            else:
-                if not self.cache_dir:
-                    source_cache = os.path.join(settings.MEDIA_ROOT, source)
-                    dest_cache = os.path.join(settings.MEDIA_ROOT, dest)
+                    do_generate = source_mod_time > dest_mod_time
+        else:
+            checked_by = 'filesystem'
+            source = os.path.join(settings.MEDIA_ROOT,
+                                  force_unicode(self.source))
+            dest = os.path.join(settings.MEDIA_ROOT, self.dest)
+            try:
+                do_generate = os.path.getmtime(source) > \
+                        os.path.getmtime(dest)
+            except OSError:
+                do_generate = True
+
+        if not do_generate and self._freshness_key is not None:
+            get_freshness_cache().mark_fresh(self._freshness_key, self.source)
+        return do_generate, checked_by, cache_hit
+
+    def _make_freshness_key(self):
+        """
+        Set and return the key the thumbnail is remembered as being fresh by,
+        which is None for thumbnails that can't be.
+        """
+        if isinstance(self.dest, basestring) and \
+           (isinstance(self.source, basestring) or
+            isinstance(self.source, File)):
+            self._freshness_key = make_freshness_key(
+                self.source, self.dest, self.width, self.height,
+                self.processor
+            )
+        return self._freshness_key
+
+    def _get_metadata_keys(self):
+        """
+        Return the keys of the source's and the thumbnail's records in the
+        metadata backend.
+        """
+        if self._source_key is None:
+            if isinstance(self.source, FieldFile) or \
+               isinstance(self.source, File):
+                source = smart_str(force_unicode(self.source))
+            elif not isinstance(self.source, basestring):
+                if self.content_key is not None:
+                    source = smart_str(self.content_key)
                 else:
-                    source_cache, dest_cache = source, dest
-                try:
-                    do_generate = os.path.getmtime(source_cache) > \
-                            os.path.getmtime(dest_cache)
-                except OSError:
-                    do_generate = True
+                    source = hash_file(self.source)
+            else:
+                source = smart_str(force_unicode(self.source))
+            self._source_key = hashlib.md5(source).hexdigest()
+        if self._dest_key is None:
+            if not isinstance(self.dest, basestring):
+                dest = hash_file(self.dest)
+            else:
+                dest = smart_str(force_unicode(self.dest))
+            self._dest_key = hashlib.md5(dest).hexdigest()
+        return self._source_key, self._dest_key
 
-            if do_generate:
-                if self.cache_dir is not None:
-                    path = os.path.split(dest)[0]
-                    if not os.path.exists(path):
-                        os.makedirs(path)
-                    open(dest, 'w').close()
-                try:
-                    self._do_generate()
-                except:
-                    if self.cache_dir is not None:
-                        if os.path.exists(dest):
-                            os.remove(dest)
-                    raise
-
-    def _do_generate(self):
+    def _generate_once(self):
+        """
+        Generate the thumbnail unless someone else is already generating it, in
+        which case wait for them to finish. If they take too long the thumbnail
+        is left pending.
+        """
+        lock = acquire_lock(self.dest)
+        if lock is None:
+            self.pending = True
+            return
+        try:
+            # Whoever had the lock before may well have just generated it,
+            # even if they were done before it was asked for.
+            if not self.is_stale():
+                self.pending = False
+                return
+            self._claim()
+            self._generate()
+        finally:
+            lock.release()
+
+    def _claim(self):
+        """
+        Record the thumbnail as being generated, which keeps anything else
+        waiting on the lock rather than taking an older record as fresh. The
+        record has no dimensions until it's done, so a claim left behind by
+        a job that was lost is generated again by whoever asks next.
+        """
+        if self.metadata is not None:
+            self.metadata.set(self._dest_key)
+
+    def _can_defer(self):
+        """
+        Only named sources can be generated later on as anything file like
+        probably won't be around once the request has finished.
+        """
+        return bool(self.background) and \
+               (isinstance(self.source, basestring) or
+                isinstance(self.source, FieldFile))
+
+    def _generate(self, image=None):
+        try:
+            data, info = self._do_generate(image)
+        except:
+            if self.metadata is not None:
+                self.metadata.delete(self._dest_key)
+            raise
+        if self.metadata is not None:
+            self.metadata.set(self._dest_key, **info)
+        self.pending = False
+        self.generated = True
+        self._exists = True
+        if self._freshness_key is not None:
+            get_freshness_cache().mark_fresh(self._freshness_key, self.source)
+        return data
+
+    def _draft(self, image):
+        """
+        Have PIL decode the image at the smallest size the processor can make do
+        with, which for JPEGs can be much faster and use far less memory.
+        """
+        draft(image, self.processor.get_decode_size(image.size, self.width,
+                                                    self.height))
+
+    def _open_source(self):
+        """
+        Return the source as an image along with any file that was opened to
+        read it, which should be closed once the image has been processed.
+
+        PIL reads straight from the source rather than a copy of it in memory.
+        Sources on the local disk are opened by their path so PIL can read
+        them itself and other storages are read through the local copy kept by
+        the source cache, if there is one, or through the file they return, a
+        part at a time if they can read ranges. Only files that can't seek are
+        read into memory first.
+        """
         if isinstance(self.source, Image.Image):
-            data = self.source
+            return self.source, None
+        file = None
+        try:
+            if not hasattr(self.source, 'read'):
+                source = force_unicode(self.source)
+                storage = self.source_storage
+                if not storage.exists(source):
+                    raise ThumbnailException('Source does not exist: %s'
+                                             % self.source)
+                try:
+                    content = storage.path(source)
+                except NotImplementedError:
+                    source_cache = get_source_cache()
+                    if source_cache is not None:
+                        file = source_cache.open(storage, source)
+                    if file is None:
+                        file = open_source(storage, source)
+                    content = file
+            else:
+                content = self.source
+            if not isinstance(content, basestring) and \
+               not hasattr(content, 'seek'):
+                content = ContentFile(content.read())
+            data = Image.open(content)
+        except IOError, detail:
+            if file is not None:
+                file.close()
+            raise ThumbnailException('%s: %s' % (detail, self.source))
+        except MemoryError:
+            if file is not None:
+                file.close()
+            raise ThumbnailException('Memory Error: %s' % self.source)
+        return data, file
+
+    def _bytes_read(self, image, file):
+        """
+        Return how much of the source was read to decode ``image``.
+        """
+        if file is None and hasattr(self.source, 'tell'):
+            file = self.source
+        if file is not None:
+            return getattr(file, 'fetched', None) or file.tell()
+        filename = getattr(image, 'filename', None)
+        if filename:
+            return os.path.getsize(filename)
+        return 0
+
+    def _do_generate(self, image=None):
+        """
+        Generate and save the thumbnail, from ``image`` instead of the source if
+        it's given, and return it along with the info to record about it.
+
+        How long each stage takes is only timed when something is listening for
+        ``thumbnail_generated``.
+        """
+        timings = start = None
+        if thumbnail_generated.receivers:
+            timings = {}
+            start = time.time()
+        bytes_read = 0
+        if image is None:
+            data, file = self._open_source()
         else:
-            try:
-                if not hasattr(self.source, 'readline'):
-                    if not hasattr(self.source, 'read'):
-                        source = force_unicode(self.source)
-                        if not default_storage.exists(source):
-                            raise ThumbnailException('Source does not exist: %s'
-                                                     % self.source)
-                        file = default_storage.open(source, 'rb')
-                        content = ContentFile(file.read())
-                        file.close()
-                    else:
-                        content = ContentFile(self.source.read())
-                else:
-                    content = ContentFile(self.source.read())
-                data = Image.open(content)
-            except IOError, detail:
-                raise ThumbnailException('%s: %s' % (detail, self.source))
-            except MemoryError:
-                raise ThumbnailException('Memory Error: %s' % self.source)
+            data, file = image, None
+        try:
+            if image is None:
+                start = lap(timings, 'open', start)
+                self._draft(data)
+                data.load()
+                start = lap(timings, 'decode', start)
+                if timings is not None:
+                    bytes_read = self._bytes_read(data, file)
+            data = self.processor.generate_thumbnail(data, self.width,
+                                                     self.height)
+            start = lap(timings, 'process', start)
+        finally:
+            if file is not None:
+                file.close()
 
         filelike = hasattr(self.dest, 'write')
         if not filelike:
-            dest = StringIO()
+            dest = get_buffer()
         else:
             dest = self.dest
 
-        data = self.processor.generate_thumbnail(data, self.width, self.height)
-
         filename = force_unicode(self.dest)
+        options = self.processor.get_save_options(filename, data)
         try:
-            data.save(dest, optimize=1, **self.processor.get_save_options(filename, data))
+            data.save(dest, optimize=1, **options)
         except IOError:
             # Try again, without optimization (PIL can't optimize an image
             # larger than ImageFile.MAXBLOCK, which is 64k by default)
+            if not filelike:
+                dest = get_buffer()
             try:
-                data.save(dest, **self.processor.get_save_options(filename, data))
+                data.save(dest, **options)
             except IOError, e:
                 raise ThumbnailException(e)
+        bytes_written = dest.tell()
+        start = lap(timings, 'encode', start)
 
         if hasattr(self.source, 'seek'):
             self.source.seek(0)
         if filelike:
             dest.seek(0)
         else:
-            if default_storage.exists(filename):
-                default_storage.delete(filename)
-            default_storage.save(filename, ContentFile(dest.getvalue()))
-            dest.close()
+            # The buffer is left at the end by the encoder and storages
+            # that read() the content rather than going through chunks()
+            # wouldn't rewind it themselves.
+            dest.seek(0)
+            content = File(dest, name=filename)
+            content.size = bytes_written
+            save_overwrite(self.dest_storage, filename, content)
+            lap(timings, 'store', start)
+
+        if timings is not None:
+            thumbnail_generated.send(
+                sender=self.__class__, thumbnail=self, timings=timings,
+                bytes_read=bytes_read, bytes_written=bytes_written
+            )
+        self._dimensions = data.size
+        return data, {
+            'width': data.size[0],
+            'height': data.size[1],
+            'format': options['format'],
+        }
+
+
+def thumbnail_async(source, width, height, proc=None, executor=None,
+                    **kwargs):
+    """
+    Return a future for a thumbnail of ``source`` that's generated, if it's
+    stale, with ``executor`` rather than in the calling thread, so that code
+    which mustn't block can ask for it and carry on. ``add_done_callback()``
+    says when it's ready. Any other arguments are passed on to
+    ``Thumbnail``.
+
+    It never waits for the executor, so when the executor already has
+    as many thumbnails as it takes the future raises ``ExecutorFull``.
+    """
+    kwargs['lazy'] = True
+    thumb = Thumbnail(source, width, height, proc=proc, **kwargs)
+    return thumb.generate_async(executor, block=False)
+
+
+def _generate(thumb):
+    thumb.generate()
+    return thumb
+
+
+def _generate_stale(thumb):
+    thumb._generate_stale()
+    return thumb
+
+
+def generate_remote(source, width, height, dest, proc, args, kwargs):
+    """
+    Rebuild and generate a thumbnail sent from another process and return
+    what happened to it for ``Thumbnail._update()``.
+    """
+    kwargs['background'] = False
+    thumb = Thumbnail(source, width, height, dest, proc, *args, **kwargs)
+    dimensions = None
+    if thumb.generated:
+        dimensions = thumb.dimensions
+    return thumb.generated, thumb.pending, dimensions
+
+
+def parse_specs(specs):
+    """
+    Turn a string such as ``"80x60 160x120:crop 320x240:crop:quality=50"`` into
+    the specs taken by ``generate_many``. Anything other than a string is
+    assumed to already be a list of specs.
+    """
+    if not isinstance(specs, basestring):
+        return specs
+    parsed = []
+    for spec in specs.split():
+        spec = spec.split(':')
+        width, height = spec[0].split('x')
+        proc = None
+        if len(spec) > 1 and spec[1]:
+            proc = spec[1]
+        options = {}
+        if len(spec) > 2:
+            for option in spec[2].split(','):
+                name, value = option.split('=')
+                if value.isdigit():
+                    value = int(value)
+                options[name.encode('utf-8')] = value
+        parsed.append((width, height, proc, options))
+    return parsed
+
+
+def generate_many(source, specs, **kwargs):
+    """
+    Generate several thumbnails of ``source`` while only reading and decoding
+    it once. Each of ``specs`` is a tuple of the width and height optionally
+    followed by the name of a processor and a dict of options for it. Any
+    keyword arguments are passed along to every thumbnail.
+
+    Thumbnails are generated from largest to smallest and those from processors
+    that keep the whole image are used in place of the source for smaller
+    thumbnails, as long as they're at least twice the size needed.
+
+    Returns a list of ``Thumbnail`` instances in the same order as ``specs``.
+    """
+    thumbs = []
+    for spec in specs:
+        options = kwargs.copy()
+        proc = None
+        if len(spec) > 2:
+            proc = spec[2]
+        if len(spec) > 3:
+            options.update(spec[3])
+        options['generate'] = False
+        thumbs.append(Thumbnail(source, spec[0], spec[1], proc=proc,
+                                **options))
+
+    stale = []
+    locks = []
+    try:
+        for thumb in thumbs:
+            if thumb.is_stale():
+                # Leave anything someone else is already generating to them.
+                lock = acquire_lock(thumb.dest, wait=0)
+                if lock is None:
+                    thumb.pending = True
+                    continue
+                locks.append(lock)
+                # Whoever had the lock before may well have just generated
+                # it.
+                if not thumb.is_stale():
+                    continue
+                thumb._claim()
+                stale.append(thumb)
+        if not stale:
+            return thumbs
+        try:
+            _generate_stale_many(stale)
+        except:
+            # Anything claimed but not generated would otherwise look fresh.
+            for thumb in stale:
+                if not thumb.generated and thumb.metadata is not None:
+                    thumb.metadata.delete(thumb._dest_key)
+            raise
+    finally:
+        for lock in locks:
+            lock.release()
+    return thumbs
+
+
+def _generate_stale_many(stale):
+    """
+    Generate the stale thumbnails from ``generate_many()``, which all have
+    the same source.
+    """
+    data, file = stale[0]._open_source()
+    try:
+        sizes = [thumb.processor.get_decode_size(data.size, thumb.width,
+                                                 thumb.height)
+                 for thumb in stale]
+        if None not in sizes:
+            draft(data, (max([size[0] for size in sizes]),
+                         max([size[1] for size in sizes])))
+        original_size = data.info.get(ORIGINAL_SIZE, data.size)
+        sizes = [thumb.processor.get_decode_size(original_size,
+                                                 thumb.width, thumb.height)
+                 for thumb in stale]
+        jobs = [((size or original_size)[0] * (size or original_size)[1],
+                 size, thumb) for size, thumb in zip(sizes, stale)]
+        jobs.sort(key=lambda job: job[0], reverse=True)
+
+        # Kept smallest first so the smallest that's big enough is found
+        # first.
+        intermediates = []
+        for area, size, thumb in jobs:
+            image = data
+            if size is not None:
+                for intermediate in intermediates:
+                    if intermediate.size[0] >= size[0] * 2 and \
+                       intermediate.size[1] >= size[1] * 2:
+                        image = intermediate
+                        break
+            image = thumb._generate(image)
+            if thumb.processor.keeps_whole_image and \
+               image.size[0] <= data.size[0] and \
+               image.size[1] <= data.size[1]:
+                image.info[ORIGINAL_SIZE] = original_size
+                intermediates.insert(0, image)
+    finally:
+        if file is not None:
+            file.close()
+
+
+def resolve_many(sources, width, height, proc=None, field=None, workers=1,
+                 executor=None, **kwargs):
+    """
+    Return a thumbnail of each of ``sources``, such as a page of objects being
+    serialized, with its ``url`` and ``dimensions`` ready to use. Sources can
+    be anything ``Thumbnail`` takes or, with ``field`` naming a file field,
+    model instances. Empty sources give None.
+
+    Rather than each thumbnail asking for itself, the thumbnails that are up
+    to date are found with one lookup in the freshness cache and one in the
+    metadata backend, or without a metadata backend with one listing of each
+    directory they're saved in. Only the rest are generated, ``workers`` at a
+    time in threads or with ``executor`` if it's given. Without a metadata
+    backend to record them, the dimensions of those that are up to date are
+    found alongside.
+    """
+    thumbs = []
+    for source in sources:
+        if field is not None:
+            source = getattr(source, field)
+        if not source:
+            thumbs.append(None)
+            continue
+        thumbs.append(Thumbnail(source, width, height, proc=proc, lazy=True,
+                                **kwargs))
+    unchecked = [thumb for thumb in thumbs if thumb is not None]
+    for thumb in unchecked:
+        # Raise any mistakes in the options before anything is looked up.
+        thumb.processor
+
+    keys = [(thumb._make_freshness_key(), thumb.source)
+            for thumb in unchecked]
+    fresh = get_freshness_cache().find_fresh(
+        [key for key in keys if key[0] is not None]
+    )
+    unchecked = [thumb for thumb in unchecked
+                 if thumb._freshness_key not in fresh]
+    metadata = get_metadata_backend()
+    unsized = []
+    if metadata is not None:
+        stale = _find_stale_by_metadata(unchecked, metadata)
+    else:
+        stale = _find_stale_by_listing(unchecked)
+        stale_ids = set([id(thumb) for thumb in stale])
+        unsized = [thumb for thumb in thumbs
+                   if thumb is not None and id(thumb) not in stale_ids and
+                   thumb._dimensions is None]
+
+    for thumb in thumbs:
+        if thumb is not None:
+            thumb._ensured = True
+    shutdown = False
+    jobs = len(stale) + len(unsized)
+    if executor is None and workers > 1 and jobs > 1:
+        executor = ThreadExecutor(min(workers, jobs))
+        shutdown = True
+    if executor is None:
+        for thumb in stale:
+            thumb._generate_stale()
+        for thumb in unsized:
+            _find_dimensions(thumb)
+        return thumbs
+    try:
+        futures = [thumb._submit(executor, _generate_stale) for thumb in stale]
+        local = executor
+        if executor.remote:
+            local = executor.local or SerialExecutor()
+        futures.extend([local.submit(_find_dimensions, (thumb,))
+                        for thumb in unsized])
+        for future in futures:
+            future.result()
+    finally:
+        if shutdown:
+            executor.shutdown()
+    return thumbs
+
+
+def _find_stale_by_metadata(thumbs, metadata):
+    """
+    Return which of ``thumbs`` are stale according to ``metadata``, which is
+    asked about all of them at once. What's recorded about those that aren't
+    is kept on them.
+    """
+    keys = []
+    for thumb in thumbs:
+        thumb._metadata = metadata
+        thumb._metadata_loaded = True
+        keys.extend(thumb._get_metadata_keys())
+    records = metadata.get_many(list(set(keys)))
+    stale = []
+    for thumb in thumbs:
+        source, dest = thumb._get_metadata_keys()
+        if source not in records:
+            records[source] = metadata.set(source)
+        record = records.get(dest)
+        if record is None or record['width'] is None or \
+           records[source]['mtime'] > record['mtime']:
+            stale.append(thumb)
+            continue
+        thumb._exists = True
+        thumb._dimensions = (record['width'], record['height'])
+        if thumb._freshness_key is not None:
+            get_freshness_cache().mark_fresh(thumb._freshness_key,
+                                             thumb.source)
+    return stale
+
+
+def _find_stale_by_listing(thumbs):
+    """
+    Return which of ``thumbs`` are stale, listing each directory they're saved
+    in once so that those that don't exist yet don't have to be asked about.
+    Those that do are compared with their source's modification time, using
+    the thumbnail's from the listing where the storage gives it.
+    """
+    listings = {}
+    stale = []
+    for thumb in thumbs:
+        dest = force_unicode(thumb.dest)
+        directory, name = os.path.split(dest)
+        key = (id(thumb.dest_storage), directory)
+        if key not in listings:
+            try:
+                listings[key] = get_modified_times(thumb.dest_storage,
+                                                   directory)
+            except (EnvironmentError, NotImplementedError):
+                listings[key] = None
+        if listings[key] is None:
+            is_stale = thumb.is_stale()
+        elif name not in listings[key]:
+            thumb._exists = False
+            is_stale = True
+        else:
+            is_stale = _is_older(thumb, listings[key][name])
+        if is_stale:
+            stale.append(thumb)
+        else:
+            thumb._exists = True
+    return stale
+
+
+def _is_older(thumb, dest_time):
+    """
+    Return whether a thumbnail found in a listing is older than its source,
+    given its modification time from the listing if there was one.
+    """
+    if not (isinstance(thumb.source, basestring) or
+            isinstance(thumb.source, FieldFile)):
+        return thumb.is_stale()
+    try:
+        source_time = thumb.source_storage.modified_time(
+            force_unicode(thumb.source)
+        )
+        if dest_time is None:
+            dest_time = thumb.dest_storage.modified_time(
+                force_unicode(thumb.dest)
+            )
+    except NotImplementedError:
+        return thumb.is_stale()
+    except EnvironmentError:
+        # Nothing can be done without the source.
+        return False
+    if source_time > dest_time:
+        return True
+    if thumb._freshness_key is not None:
+        get_freshness_cache().mark_fresh(thumb._freshness_key, thumb.source)
+    return False
+
+
+def _find_dimensions(thumb):
+    try:
+        thumb.dimensions
+    except ThumbnailException:
+        # Left for whoever asks for them to find out about.
+        pass
+    return thumb
@@ -0,0 +1,202 @@
+import os
+import traceback
+from multiprocessing import Pool
+from optparse import make_option
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.fields.files import FieldFile
+from django.utils.encoding import force_unicode, smart_str
+from cuddlybuddly.thumbnail import find_file_models
+from cuddlybuddly.thumbnail.main import generate_many, parse_specs, Thumbnail
+from cuddlybuddly.thumbnail.storage import get_source_storage
+
+
+def pregenerate(args):
+    """
+    Generate the stale thumbnails of a single source, or only find them when
+    ``dry_run`` is true. Returns the source's name along with the names of the
+    stale thumbnails and the traceback of any error.
+    """
+    source, specs, dry_run = args
+    if isinstance(source, tuple):
+        # A file from a model sent by send_source().
+        model, field, name = source
+        source = FieldFile(None, model._meta.get_field(field), name)
+    try:
+        if dry_run:
+            stale = []
+            for spec in specs:
+                options = dict(spec[3])
+                options['generate'] = False
+                thumb = Thumbnail(source, spec[0], spec[1], proc=spec[2],
+                                  **options)
+                if thumb.is_stale():
+                    stale.append(force_unicode(thumb))
+        else:
+            stale = [force_unicode(thumb)
+                     for thumb in generate_many(source, specs)
+                     if thumb.generated]
+    except Exception:
+        return force_unicode(source), [], traceback.format_exc()
+    return force_unicode(source), stale, None
+
+
+def send_source(source):
+    """
+    Return ``source`` in a form that can be sent to another process. Pickling
+    a ``FieldFile`` drops its storage, so the model and field are sent along
+    with its name instead.
+    """
+    if isinstance(source, FieldFile):
+        return source.field.model, source.field.name, source.name
+    return source
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-s', '--size', action='append', dest='sizes', default=[],
+            help='A size to generate such as 80x60, 80x60:crop or '
+                 '80x60:crop:quality=50. Can be given more than once.'),
+        make_option('--model', action='append', dest='models', default=[],
+            help='Only walk the file fields of this model, such as '
+                 'photos.Photo. Can be given more than once.'),
+        make_option('--prefix', action='append', dest='prefixes', default=[],
+            help='Walk the images in the storage under this path instead of '
+                 'the file fields of models. Can be given more than once.'),
+        make_option('-p', '--processes', type='int', dest='processes',
+            default=1, help='The number of processes to generate with.'),
+        make_option('--resume', dest='resume',
+            help='A file to record every finished source in so that an '
+                 'interrupted run can carry on where it left off.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='Only list the thumbnails that would be generated.'),
+    )
+    help = 'Generates any missing or stale thumbnails ahead of time.'
+
+    def handle(self, *args, **options):
+        specs = []
+        for size in options['sizes']:
+            try:
+                specs.extend(parse_specs(size))
+            except ValueError:
+                raise CommandError('Invalid size: %s' % size)
+        if not specs:
+            raise CommandError('At least one --size is required.')
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['prefixes']:
+            sources = []
+            for prefix in options['prefixes']:
+                sources.extend(self.walk_storage(prefix))
+        else:
+            sources = self.walk_models(options['models'])
+
+        done = set()
+        resume = None
+        if options['resume']:
+            if os.path.exists(options['resume']):
+                resume = open(options['resume'], 'r')
+                try:
+                    done = set([line.rstrip('\n').decode('utf-8')
+                                for line in resume])
+                finally:
+                    resume.close()
+            if not options['dry_run']:
+                resume = open(options['resume'], 'a')
+        # Several records can share a file so only visit each source once.
+        unique = []
+        for source in sources:
+            name = force_unicode(source)
+            if name not in done:
+                done.add(name)
+                unique.append(source)
+        sources = unique
+
+        jobs = [(source, specs, options['dry_run']) for source in sources]
+        if options['processes'] > 1:
+            jobs = [(send_source(job[0]),) + job[1:] for job in jobs]
+            # Forked processes mustn't share the database connection.
+            connection.close()
+            pool = Pool(options['processes'])
+            results = pool.imap_unordered(pregenerate, jobs)
+        else:
+            pool = None
+            results = (pregenerate(job) for job in jobs)
+
+        total = len(jobs)
+        generated = errors = 0
+        try:
+            for i, (source, stale, error) in enumerate(results):
+                if error is not None:
+                    errors += 1
+                    self.stderr.write(smart_str(
+                        u'Failed %s\n%s\n' % (source, error)
+                    ))
+                    continue
+                generated += len(stale)
+                if resume is not None:
+                    resume.write(smart_str(source) + '\n')
+                    resume.flush()
+                if verbosity > 1 or (options['dry_run'] and verbosity > 0):
+                    for name in stale:
+                        self.stdout.write(smart_str(u'%s\n' % name))
+                if verbosity > 0:
+                    self.stdout.write('\r%s/%s sources' % (i + 1, total))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if resume is not None:
+                resume.close()
+        if verbosity > 0:
+            if options['dry_run']:
+                action = 'would be generated'
+            else:
+                action = 'generated'
+            self.stdout.write('\n%s thumbnails %s, %s errors\n'
+                              % (generated, action, errors))
+
+    def walk_models(self, models):
+        """
+        Find the files in every file field of ``models``, or of every model
+        when there aren't any, as ``FieldFile`` instances so that each is read
+        from its field's storage.
+        """
+        sources = []
+        for model, fields in find_file_models():
+            name = '%s.%s' % (model._meta.app_label, model.__name__)
+            if models and name not in models:
+                continue
+            for instance in model._default_manager.only(*fields).iterator():
+                for field in fields:
+                    value = getattr(instance, field)
+                    if value:
+                        sources.append(value)
+        return sources
+
+    def walk_storage(self, path):
+        """
+        Find every image under ``path`` in the source storage, skipping over
+        any directories thumbnails are kept in.
+        """
+        Image.init()
+        skip = set([
+            getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_BASEDIR', ''),
+            getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_SUBDIR', ''),
+        ])
+        skip.discard('')
+        sources = []
+        dirs, files = get_source_storage().listdir(path)
+        for name in files:
+            if os.path.splitext(name)[1].lower() in Image.EXTENSION:
+                sources.append(os.path.join(path, name))
+        for name in dirs:
+            if name not in skip:
+                sources.extend(self.walk_storage(os.path.join(path, name)))
+        return sources
@@ -0,0 +1,264 @@
+import errno
+import os
+import sqlite3
+import threading
+import time
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+try:
+    from django.core.cache import caches
+except ImportError:
+    caches = None
+    from django.core.cache import get_cache
+
+
+FIELDS = ('width', 'height', 'format')
+
+_connections = threading.local()
+_caches = {}
+
+
+class BaseBackend(object):
+    """
+    Somewhere to record what is known about sources and thumbnails so that
+    deciding whether a thumbnail needs generating doesn't have to go anywhere
+    near the storage.
+
+    Records are looked up by the keys built in ``Thumbnail.generate()`` and are
+    dicts with ``mtime`` holding the time the record was set, along with
+    ``width``, ``height`` and ``format`` when they are known.
+    """
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        Return a dict of the records that exist for ``keys``.
+        """
+        raise NotImplementedError()
+
+    def set(self, key, **info):
+        """
+        Record ``key`` as being seen now, along with any of ``width``,
+        ``height`` and ``format`` and return the new record.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def _record(self, info):
+        record = dict([(k, info.get(k)) for k in FIELDS])
+        record['mtime'] = time.time()
+        return record
+
+
+class FileBackend(BaseBackend):
+    """
+    The original layout of ``CUDDLYBUDDLY_THUMBNAIL_CACHE``, a file per key
+    with the record's time being the file's modification time. Dimensions and
+    format are written into the otherwise empty file.
+    """
+
+    def __init__(self, location=None):
+        if location is None:
+            location = settings.CUDDLYBUDDLY_THUMBNAIL_CACHE
+        self.location = location
+
+    def get_many(self, keys):
+        records = {}
+        for key in keys:
+            path = os.path.join(self.location, key)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            record = dict([(k, None) for k in FIELDS])
+            record['mtime'] = stat.st_mtime
+            info = []
+            if stat.st_size:
+                file = open(path, 'r')
+                try:
+                    info = file.read().split()
+                finally:
+                    file.close()
+            if len(info) == len(FIELDS):
+                record.update({
+                    'width': int(info[0]),
+                    'height': int(info[1]),
+                    'format': info[2],
+                })
+            records[key] = record
+        return records
+
+    def set(self, key, **info):
+        if not os.path.exists(self.location):
+            try:
+                os.makedirs(self.location)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        record = self._record(info)
+        path = os.path.join(self.location, key)
+        file = open(path, 'w')
+        try:
+            if record['width'] is not None:
+                file.write('%(width)s %(height)s %(format)s' % record)
+        finally:
+            file.close()
+        record['mtime'] = os.path.getmtime(path)
+        return record
+
+    def delete_many(self, keys):
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.location, key))
+            except OSError:
+                pass
+
+    def clear(self):
+        for key in os.listdir(self.location):
+            self.delete(key)
+
+
+class SQLiteBackend(BaseBackend):
+    """
+    Keeps every record in a single indexed SQLite database, which defaults to
+    ``metadata.sqlite3`` inside ``CUDDLYBUDDLY_THUMBNAIL_CACHE``.
+    """
+
+    def __init__(self, location=None):
+        if location is None:
+            location = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_METADATA_DB',
+                               None)
+        if location is None:
+            location = os.path.join(settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                                    'metadata.sqlite3')
+        self.location = location
+
+    def _get_connection(self):
+        connections = _connections.__dict__.setdefault('sqlite', {})
+        if self.location not in connections:
+            path = os.path.dirname(self.location)
+            if path and not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            connection = sqlite3.connect(self.location, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS metadata ('
+                'key TEXT PRIMARY KEY, mtime REAL, width INTEGER, '
+                'height INTEGER, format TEXT)'
+            )
+            connection.commit()
+            connections[self.location] = connection
+        return connections[self.location]
+    connection = property(_get_connection)
+
+    def _chunks(self, keys):
+        # SQLite only allows 999 parameters in a single statement.
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            yield keys[i:i+500]
+
+    def get_many(self, keys):
+        records = {}
+        for chunk in self._chunks(keys):
+            rows = self.connection.execute(
+                'SELECT key, mtime, width, height, format FROM metadata '
+                'WHERE key IN (%s)' % ', '.join(['?'] * len(chunk)),
+                chunk
+            )
+            for row in rows:
+                records[row[0]] = {
+                    'mtime': row[1],
+                    'width': row[2],
+                    'height': row[3],
+                    'format': row[4],
+                }
+        return records
+
+    def set(self, key, **info):
+        record = self._record(info)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO metadata (key, mtime, width, height, '
+            'format) VALUES (?, ?, ?, ?, ?)',
+            (key, record['mtime'], record['width'], record['height'],
+             record['format'])
+        )
+        self.connection.commit()
+        return record
+
+    def delete_many(self, keys):
+        for chunk in self._chunks(keys):
+            self.connection.execute(
+                'DELETE FROM metadata WHERE key IN (%s)'
+                % ', '.join(['?'] * len(chunk)),
+                chunk
+            )
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM metadata')
+        self.connection.commit()
+
+
+class CacheBackend(BaseBackend):
+    """
+    Keeps records in one of Django's caches, named by
+    ``CUDDLYBUDDLY_THUMBNAIL_METADATA_CACHE``. Records evicted from the cache
+    just mean thumbnails being generated again, and ``clear()`` empties the
+    whole cache so it's best to give it one of its own.
+    """
+
+    prefix = 'cuddlybuddly.thumbnail.metadata.'
+
+    def __init__(self, alias=None):
+        if alias is None:
+            alias = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_METADATA_CACHE',
+                            'default')
+        if alias not in _caches:
+            if caches is not None:
+                _caches[alias] = caches[alias]
+            else:
+                _caches[alias] = get_cache(alias)
+        self.cache = _caches[alias]
+
+    def get_many(self, keys):
+        records = self.cache.get_many([self.prefix + key for key in keys])
+        return dict([(k[len(self.prefix):], v) for k, v in records.items()])
+
+    def set(self, key, **info):
+        record = self._record(info)
+        self.cache.set(self.prefix + key, record, getattr(
+            settings, 'CUDDLYBUDDLY_THUMBNAIL_METADATA_TIMEOUT', None
+        ))
+        return record
+
+    def delete_many(self, keys):
+        self.cache.delete_many([self.prefix + key for key in keys])
+
+    def clear(self):
+        self.cache.clear()
+
+
+def get_backend():
+    """
+    Return the configured metadata backend or None if there isn't one.
+    """
+    backend = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_METADATA_BACKEND', None)
+    if backend is None:
+        if getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_CACHE', None) is None:
+            return None
+        backend = 'cuddlybuddly.thumbnail.metadata.FileBackend'
+    return get_callable(backend)()
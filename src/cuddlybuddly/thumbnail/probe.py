@@ -0,0 +1,76 @@
+try:
+    from PIL import Image, ImageFile
+except ImportError:
+    import Image, ImageFile
+from django.utils.encoding import force_unicode
+from cuddlybuddly.thumbnail.exceptions import ThumbnailException
+from cuddlybuddly.thumbnail.storage import get_source_storage, open_source
+
+
+# How much of a file is read at first to find its header, which is doubled
+# until it's found or this much has been read.
+CHUNK_SIZE = 1024
+MAX_HEADER_SIZE = 2**20
+
+
+def probe(source, storage=None):
+    """
+    Return the width, height and format of an image while reading no more of
+    it than its header. ``source`` can be a path in ``storage``, which
+    defaults to the source storage, a model's file field, a file like object
+    or an already open image.
+    """
+    if isinstance(source, Image.Image):
+        return source.size + (source.format,)
+    if hasattr(source, 'read'):
+        position = None
+        if hasattr(source, 'seek'):
+            position = source.tell()
+            source.seek(0)
+        try:
+            return probe_file(source)
+        finally:
+            if position is not None:
+                source.seek(position)
+    name = force_unicode(source)
+    storage = get_source_storage(storage)
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        # Storages that stream their files or can read part of them only have
+        # to fetch the first few chunks.
+        try:
+            file = open_source(storage, name)
+            try:
+                return probe_file(file)
+            finally:
+                file.close()
+        except EnvironmentError:
+            raise ThumbnailException('Source does not exist: %s' % name)
+    try:
+        # PIL reads the header and leaves the rest until the image is loaded.
+        image = Image.open(path)
+    except IOError, e:
+        raise ThumbnailException('%s: %s' % (e, name))
+    return image.size + (image.format,)
+
+
+def probe_file(file):
+    """
+    Feed a file to PIL a chunk at a time until it has found the header, which
+    doesn't need the file to be able to seek.
+    """
+    parser = ImageFile.Parser()
+    chunk_size = CHUNK_SIZE
+    read = 0
+    while parser.image is None and read < MAX_HEADER_SIZE:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        read += len(chunk)
+        chunk_size *= 2
+    if parser.image is None:
+        raise ThumbnailException('Not an image or its header is too big: %s'
+                                 % getattr(file, 'name', file))
+    return parser.image.size + (parser.image.format,)
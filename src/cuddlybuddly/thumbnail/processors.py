@@ -1,14 +1,47 @@
+import math
 import os
 try:
-    from PIL import Image, ImageOps
+    from PIL import Image
 except ImportError:
-    import Image, ImageOps
+    import Image
+
+
+# Where the size of the source image is kept in Image.info when it has been
+# decoded at a smaller size than it really is.
+ORIGINAL_SIZE = 'cuddlybuddly.thumbnail.original_size'
+
+# The ways images can be resampled, from slowest and best to fastest and
+# worst. Each is how many times bigger than the thumbnail images are first
+# shrunk to by averaging whole blocks of pixels, or None to not shrink them
+# first, and the filter used to resize them the rest of the way.
+RESAMPLE = {
+    'quality': (None, Image.ANTIALIAS),
+    'balanced': (3, Image.ANTIALIAS),
+    'fast': (2, Image.BILINEAR),
+}
+# How far the widest of PIL's filters reaches, in pixels of the resized image.
+FILTER_SUPPORT = 3
 
 
 class BaseProcessor(object):
     # PIL defaults to 75 but since we've been using 85 since sorl-thumbnail we
     # should keep it at 85 to prevent mass regeneration of thumbnails.
     quality = 85
+    # The format to save thumbnails as, such as 'WEBP', instead of the one
+    # their filename's extension implies.
+    format = None
+    # How images are resized, one of the keys of RESAMPLE.
+    resample = 'quality'
+    # Whether generate_thumbnail() returns the whole of the source image just
+    # resized, so that its thumbnails can stand in for the source when making
+    # smaller thumbnails. Subclasses that crop or otherwise change the image
+    # shouldn't set this.
+    keeps_whole_image = False
+    # The options that are already part of the filename, either by
+    # generate_filename() or, for format, the extension. Any other options the
+    # processor declares are added to the filename as a short hash when
+    # they're given.
+    filename_options = ('format',)
 
     def __init__(self, *args, **kwargs):
         for name, value in kwargs.items():
@@ -33,6 +66,34 @@ class BaseProcessor(object):
         """
         raise NotImplementedError()
 
+    def get_size(self, size, width, height):
+        """
+        Return the size the thumbnail of a source image of ``size`` will be, or
+        None if it can't be known without generating it.
+        """
+        return None
+
+    def get_decode_size(self, size, width, height):
+        """
+        Return the smallest size a source image of ``size`` can be decoded at
+        without affecting the thumbnail, or None for it to be decoded at full
+        size. JPEGs can be decoded at a half, quarter or eighth of their size
+        far more quickly than at full size.
+
+        When the image is decoded at a smaller size its real size is kept in
+        ``image.info`` and can be found with ``_original_size()``.
+        """
+        return None
+
+    def get_format(self, filename):
+        """
+        Return the format a thumbnail saved as ``filename`` is saved in.
+        """
+        if self.format:
+            return self.format.upper()
+        return Image.EXTENSION.get(os.path.splitext(filename)[1].lower(),
+                                   'JPEG')
+
     def get_save_options(self, filename, image):
         """
         Return the options for Image's save() method. The available options vary
@@ -45,9 +106,7 @@ class BaseProcessor(object):
         available options.
         """
 
-        format = Image.EXTENSION.get(
-            os.path.splitext(filename)[1].lower(), 'JPEG'
-        )
+        format = self.get_format(filename)
         options = {
             'format': format,
             'quality': self.quality,
@@ -58,6 +117,76 @@ class BaseProcessor(object):
                 options['transparency'] = transparency
         return options
 
+    def _original_size(self, image):
+        return image.info.get(ORIGINAL_SIZE, image.size)
+
+    def _get_filter_region(self, image_size, box, size):
+        """
+        Return the whole pixels a filter reads when resizing the part of an
+        image in ``box`` to ``size``.
+        """
+        region = []
+        for i in (0, 1):
+            scale = max((box[i + 2] - box[i]) / float(size[i]), 1.0)
+            margin = int(math.ceil(FILTER_SUPPORT * scale)) + 2
+            region.append((max(int(math.floor(box[i])) - margin, 0),
+                           min(int(math.ceil(box[i + 2])) + margin,
+                               image_size[i])))
+        (left, right), (top, bottom) = region
+        return (left, top, right, bottom)
+
+    def _crop(self, image, box, size):
+        """
+        Crop the image down to what's needed to resize the part of it in
+        ``box`` to ``size`` and return it along with ``box`` moved to match.
+        """
+        left, top, right, bottom = self._get_filter_region(image.size, box,
+                                                           size)
+        if (left, top, right, bottom) == (0, 0) + image.size:
+            return image, box
+        return image.crop((left, top, right, bottom)), (
+            box[0] - left, box[1] - top, box[2] - left, box[3] - top
+        )
+
+    def _reduce(self, image, size, box=None):
+        """
+        Shrink the image by a whole factor, which is much faster than any
+        filter, as long as the part of it in ``box`` stays at least as many
+        times bigger than ``size`` as ``resample`` allows. Returns the image
+        along with ``box`` scaled to match it.
+        """
+        if box is None:
+            box = (0, 0) + image.size
+        gap = RESAMPLE[self.resample][0]
+        if gap is None:
+            return image, box
+        factor = int(min((box[2] - box[0]) / (size[0] * float(gap)),
+                         (box[3] - box[1]) / (size[1] * float(gap))))
+        if factor < 2:
+            return image, box
+        image, box = self._crop(image, box, size)
+        if hasattr(image, 'reduce'):
+            reduced = image.reduce(factor)
+            scale = (1.0 / factor, 1.0 / factor)
+        else:
+            reduced = image.resize(
+                (image.size[0] // factor, image.size[1] // factor),
+                resample=getattr(Image, 'BOX', Image.BILINEAR)
+            )
+            scale = (float(reduced.size[0]) / image.size[0],
+                     float(reduced.size[1]) / image.size[1])
+        return reduced, (box[0] * scale[0], box[1] * scale[1],
+                         box[2] * scale[0], box[3] * scale[1])
+
+    def _resize(self, image, size, box=None):
+        """
+        Resize the part of the image in ``box``, or all of it, in the way
+        chosen by ``resample``.
+        """
+        image, box = self._reduce(image, size, box)
+        return image.resize(size, resample=RESAMPLE[self.resample][1],
+                            box=box)
+
     def _colorspace(self, im, bw=False, replace_alpha=False):
         """
         A utility method taken from SmileyChris' easy-thumbnails that a lot of
@@ -100,6 +229,8 @@ class ResizeProcessor(BaseProcessor):
     """
 
     upscale = False
+    keeps_whole_image = True
+    filename_options = ('format', 'quality', 'upscale')
 
     def generate_filename(self, filename, width, height):
         """
@@ -113,18 +244,25 @@ class ResizeProcessor(BaseProcessor):
         return '%s_%sx%s_q%s%s%s' % (name, width, height, self.quality, upscale,
                                      ext)
 
-    def generate_thumbnail(self, image, width, height):
-        image = self._colorspace(image)
-        source_x, source_y = [float(v) for v in image.size]
+    def get_size(self, size, width, height):
+        source_x, source_y = [float(v) for v in size]
         target_x, target_y = [float(v) for v in (width, height)]
         scale = min(target_x / source_x, target_y / source_y)
         if scale < 1.0 or (scale > 1.0 and self.upscale):
-            # There's also image.thumbnail which is meant to be faster but lower
-            # quality.
-            image = image.resize(
-                (int(round(source_x * scale)), int(round(source_y * scale))),
-                resample=Image.ANTIALIAS
-            )
+            return (int(round(source_x * scale)), int(round(source_y * scale)))
+        return tuple(size)
+
+    def get_decode_size(self, size, width, height):
+        target = self.get_size(size, width, height)
+        if target[0] < size[0] and target[1] < size[1]:
+            return target
+        return None
+
+    def generate_thumbnail(self, image, width, height):
+        image = self._colorspace(image)
+        size = self.get_size(self._original_size(image), width, height)
+        if size != image.size:
+            image = self._resize(image, size)
         return image
 
 
@@ -135,6 +273,8 @@ class CropToFitProcessor(ResizeProcessor):
     150x100 image resized to 50x50 will end up as 50x50 with the left and right
     cropped off.
     """
+    keeps_whole_image = False
+
     def generate_filename(self, *args, **kwargs):
         filename = super(CropToFitProcessor, self).generate_filename(
             *args, **kwargs
@@ -142,6 +282,54 @@ class CropToFitProcessor(ResizeProcessor):
         basename, ext = os.path.splitext(filename)
         return '%s_ctf%s' % (basename, ext)
 
+    def get_size(self, size, width, height):
+        return (width, height)
+
+    def get_decode_size(self, size, width, height):
+        scale = max(float(width) / size[0], float(height) / size[1])
+        if scale < 1.0:
+            return (int(math.ceil(size[0] * scale)),
+                    int(math.ceil(size[1] * scale)))
+        return None
+
+    def get_crop_box(self, size, width, height):
+        """
+        Return the part of an image of ``size`` that is kept, worked out in
+        exactly the same way as ``ImageOps.fit()`` so that cropping before
+        resizing doesn't change any thumbnails.
+        """
+        source_x, source_y = [float(v) for v in size]
+        source_ratio = source_x / source_y
+        target_ratio = float(width) / height
+        if source_ratio == target_ratio:
+            crop_x, crop_y = source_x, source_y
+        elif source_ratio >= target_ratio:
+            crop_x, crop_y = target_ratio * source_y, source_y
+        else:
+            crop_x, crop_y = source_x, source_x / target_ratio
+        left = (source_x - crop_x) * 0.5
+        top = (source_y - crop_y) * 0.5
+        return (left, top, left + crop_x, top + crop_y)
+
     def generate_thumbnail(self, image, width, height):
-        image = self._colorspace(image)
-        return ImageOps.fit(image, (width, height), Image.ANTIALIAS)
+        size = (width, height)
+        box = self.get_crop_box(image.size, width, height)
+        region = self._get_filter_region(image.size, box, size)
+        if image.mode in ('L', 'RGB') or region == (0, 0) + image.size:
+            return self._resize(self._colorspace(image), size, box)
+
+        # Only convert what's kept. Resampling the box from a cropped image
+        # would round differently and change thumbnails, so the converted
+        # part goes back where it was on an otherwise empty image.
+        part = self._colorspace(image.crop(region))
+        # PIL premultiplies alpha before resampling, which is as slow as
+        # converting and so is done here for just the part too.
+        premultiply = part.mode == 'RGBA'
+        if premultiply:
+            part = part.convert('RGBa')
+        image = Image.new(part.mode, image.size)
+        image.paste(part, region[:2])
+        image = self._resize(image, size, box)
+        if premultiply:
+            image = image.convert('RGBA')
+        return image
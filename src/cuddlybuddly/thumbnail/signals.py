@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+
+# Sent every time a thumbnail is checked for whether it needs generating.
+# checked_by is one of 'freshness', 'metadata', 'storage' or 'filesystem' and
+# cache_hit is whether the cache had a record of the thumbnail, or None if no
+# cache was asked. duration is in seconds.
+thumbnail_checked = Signal(providing_args=[
+    'thumbnail', 'stale', 'checked_by', 'cache_hit', 'duration'
+])
+
+# Sent every time a thumbnail is generated. timings is a dict of the seconds
+# taken by each of the 'open', 'decode', 'process', 'encode' and 'store'
+# stages, although only those that happened are included.
+thumbnail_generated = Signal(providing_args=[
+    'thumbnail', 'timings', 'bytes_read', 'bytes_written'
+])
@@ -0,0 +1,115 @@
+import errno
+import hashlib
+import os
+from django.conf import settings
+from django.utils.encoding import force_unicode, smart_str
+from cuddlybuddly.thumbnail.storage import save_local
+
+
+class SourceCache(object):
+    """
+    Keeps copies of sources from remote storages on the local disk so that
+    generating several thumbnails of a source, or generating them all again,
+    only downloads it once.
+
+    Copies are named after the source's path and version, which is its
+    storage's ``etag(name)`` if it has one and otherwise its modification
+    time, so changed sources are downloaded again and the old copies are
+    evicted in time. Once the copies add up to more than ``max_size`` bytes
+    the least recently used are deleted.
+
+    Several processes can share a directory. Copies are written to a
+    temporary file and renamed into place so nobody reads one that's half
+    written, and they're handed out already open so that another process
+    evicting them doesn't matter.
+    """
+
+    def __init__(self, location, max_size):
+        self.location = location
+        self.max_size = max_size
+
+    def get_version(self, storage, name):
+        if hasattr(storage, 'etag'):
+            return storage.etag(name)
+        try:
+            return storage.modified_time(name).isoformat()
+        except NotImplementedError:
+            return None
+
+    def open(self, storage, name):
+        """
+        Return the local copy of ``name`` in ``storage`` opened for reading,
+        downloading it first if there isn't one yet, or None if the source's
+        version can't be told and so it can't be cached.
+        """
+        name = force_unicode(name)
+        version = self.get_version(storage, name)
+        if version is None:
+            return None
+        path = os.path.join(self.location, hashlib.md5(
+            smart_str(u'%s\0%s' % (name, version))
+        ).hexdigest())
+        try:
+            file = open(path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            # The modification time is when it was last used.
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            return file
+        source = storage.open(name, 'rb')
+        try:
+            save_local(path, source)
+        finally:
+            source.close()
+        file = open(path, 'rb')
+        self.evict(keep=path)
+        return file
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used copies until they fit in
+        ``max_size``, other than ``keep``.
+        """
+        files = []
+        total = 0
+        for filename in os.listdir(self.location):
+            if filename.startswith('.'):
+                # Still being written.
+                continue
+            path = os.path.join(self.location, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Someone else got there first.
+                pass
+            total -= size
+
+
+def get_source_cache():
+    """
+    Return the source cache or None if ``CUDDLYBUDDLY_THUMBNAIL_SOURCE_CACHE``
+    isn't set.
+    """
+    location = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_SOURCE_CACHE', None)
+    if location is None:
+        return None
+    return SourceCache(location, getattr(
+        settings, 'CUDDLYBUDDLY_THUMBNAIL_SOURCE_CACHE_SIZE', 256 * 2**20
+    ))
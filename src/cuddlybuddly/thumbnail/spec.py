@@ -0,0 +1,91 @@
+import hashlib
+import json
+from django.core import signing
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.encoding import smart_str
+
+
+SALT = 'cuddlybuddly.thumbnail.spec'
+
+
+def get_processor_path(processor):
+    return '%s.%s' % (processor.__class__.__module__,
+                      processor.__class__.__name__)
+
+
+def get_options(processor):
+    """
+    Return the options a processor was given, none of which are left out
+    since unknown options may still be used by subclasses.
+    """
+    return dict(processor.__dict__)
+
+
+def get_extra_options(processor):
+    """
+    Return the options a processor was given that can change the thumbnail
+    but aren't already part of the filename it generates. Only options the
+    processor declares as attributes can change anything.
+    """
+    return dict([
+        (k, v) for k, v in processor.__dict__.items()
+        if hasattr(processor.__class__, k) and
+           k not in processor.filename_options
+    ])
+
+
+def serialize(processor, width, height, options=None):
+    """
+    Return the canonical form of a thumbnail's spec, which is the same for the
+    same processor, size and options no matter what order they were given in.
+    """
+    if options is None:
+        options = get_options(processor)
+    return json.dumps(
+        [get_processor_path(processor), int(width), int(height), options],
+        separators=(',', ':'), sort_keys=True, default=repr
+    )
+
+
+def get_key(processor, width, height, options=None):
+    """
+    Return a short hash of the spec to tell thumbnails apart by.
+
+    It isn't signed so that thumbnails keep the same names when
+    ``SECRET_KEY`` changes. Anything that will come back in a url should go
+    through ``dumps()`` instead.
+    """
+    return hashlib.sha1(
+        serialize(processor, width, height, options)
+    ).hexdigest()[:10]
+
+
+def _signature(data, salt):
+    return salted_hmac(SALT + salt, data).hexdigest()[:16]
+
+
+def dumps(value, salt=''):
+    """
+    Return ``value`` as a compact, url safe and signed string. Unlike
+    ``django.core.signing.dumps()`` there is no timestamp so the same value
+    always gives the same string.
+    """
+    data = signing.b64_encode(json.dumps(value, separators=(',', ':'),
+                                         sort_keys=True))
+    return '%s.%s' % (data, _signature(data, smart_str(salt)))
+
+
+def loads(value, salt=''):
+    """
+    Reverse ``dumps()``, raising ``django.core.signing.BadSignature`` if the
+    value wasn't signed with the same salt.
+    """
+    value = smart_str(value)
+    if '.' not in value:
+        raise signing.BadSignature('No signature in "%s"' % value)
+    data, signature = value.rsplit('.', 1)
+    if not constant_time_compare(signature, _signature(data,
+                                                       smart_str(salt))):
+        raise signing.BadSignature('Signature "%s" does not match'
+                                   % signature)
+    return json.loads(signing.b64_decode(data))
@@ -0,0 +1,231 @@
+import errno
+import os
+import uuid
+from datetime import datetime
+from django.conf import settings
+from django.core.files.storage import default_storage, FileSystemStorage, \
+    get_storage_class
+
+
+_storages = {}
+
+
+def get_storage(storage=None, setting=None):
+    """
+    Return ``storage`` if it's a storage or an instance of the storage class it
+    names if it's a dotted path. Without one, the storage named by
+    ``setting`` is used, and otherwise ``default_storage``. Storages named by
+    a path are only created once.
+    """
+    if storage is None and setting is not None:
+        storage = getattr(settings, setting, None)
+    if storage is None:
+        return default_storage
+    if isinstance(storage, basestring):
+        if storage not in _storages:
+            _storages[storage] = get_storage_class(storage)()
+        return _storages[storage]
+    return storage
+
+
+def get_source_storage(storage=None):
+    return get_storage(storage, 'CUDDLYBUDDLY_THUMBNAIL_SOURCE_STORAGE')
+
+
+def get_dest_storage(storage=None):
+    return get_storage(storage, 'CUDDLYBUDDLY_THUMBNAIL_DEST_STORAGE')
+
+
+def save_overwrite(storage, name, content):
+    """
+    Save ``content`` to ``name`` in ``storage``, replacing whatever is already
+    there, and return the name it was saved as.
+
+    Storages can do this themselves by implementing ``save_overwrite(name,
+    content)``, which remote storages should do in a single request. Storages
+    that already overwrite on save, like those with ``file_overwrite`` set in
+    django-storages, are just saved to. Files on the local disk are written to
+    a temporary file and renamed over the old one so that nobody ever sees
+    them missing or half written. Anything else falls back to deleting the old
+    file first, otherwise the storage would save under a different name.
+    """
+    if hasattr(storage, 'save_overwrite'):
+        return storage.save_overwrite(name, content)
+    if getattr(storage, 'file_overwrite', False):
+        return storage.save(name, content)
+    if isinstance(storage, FileSystemStorage):
+        save_local(storage.path(name), content)
+        return name
+    if storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, content)
+
+
+def save_local(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    # Kept in the same directory so the rename can't cross filesystems.
+    temp = os.path.join(directory, '.%s.%s.tmp' % (os.path.basename(path),
+                                                   uuid.uuid4().hex))
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                 getattr(os, 'O_BINARY', 0), 0666)
+    try:
+        try:
+            for chunk in content.chunks():
+                os.write(fd, chunk)
+        finally:
+            os.close(fd)
+        permissions = getattr(settings, 'FILE_UPLOAD_PERMISSIONS', None)
+        if permissions is not None:
+            os.chmod(temp, permissions)
+        if os.name == 'nt' and os.path.exists(path):
+            # Windows won't rename over an existing file.
+            os.remove(path)
+        os.rename(temp, path)
+    except:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+def get_modified_times(storage, path):
+    """
+    Return a dict of the modification time of each file in ``path``. Storages
+    that list files along with their times, as S3 and the like do, can
+    implement ``modified_times(path)`` to answer in a single request. Files on
+    the local disk are looked up with ``os.stat()`` and the times of those in
+    other storages are None, to be asked for one at a time.
+    """
+    if hasattr(storage, 'modified_times'):
+        return storage.modified_times(path)
+    names = storage.listdir(path)[1]
+    try:
+        directory = storage.path(path)
+    except NotImplementedError:
+        return dict([(name, None) for name in names])
+    times = {}
+    for name in names:
+        try:
+            times[name] = datetime.fromtimestamp(
+                os.path.getmtime(os.path.join(directory, name))
+            )
+        except OSError:
+            # Deleted since it was listed.
+            pass
+    return times
+
+
+def open_source(storage, name):
+    """
+    Open ``name`` in ``storage`` for PIL to read from. Storages that can read
+    part of a file, by implementing ``read_range(name, start, end)``, are only
+    asked for the parts PIL reads rather than the whole file.
+    """
+    if hasattr(storage, 'read_range'):
+        return RangeFile(storage, name)
+    return storage.open(name, 'rb')
+
+
+class RangeFile(object):
+    """
+    A read only file that fetches the parts of a file that are read from its
+    storage's ``read_range(name, start, end)``, which returns the bytes from
+    ``start`` up to but not including ``end``.
+
+    Reads start at ``block_size`` and whenever they carry on from where the
+    last one finished the next is twice as big, up to ``max_block_size``, so
+    that reading a header takes one small request and decoding the whole file
+    doesn't take hundreds. Everything fetched is kept until the file is
+    closed as PIL often seeks back over what it has read.
+    """
+
+    def __init__(self, storage, name, block_size=16 * 2**10,
+                 max_block_size=2**20):
+        self.storage = storage
+        self.name = name
+        self.block_size = block_size
+        self.max_block_size = max_block_size
+        self.position = 0
+        self.fetched = 0
+        self.closed = False
+        self._size = None
+        self._next_size = block_size
+        self._last_end = None
+        # Contiguous (start, data) pairs in order.
+        self._parts = []
+
+    def _get_size(self):
+        if self._size is None:
+            self._size = self.storage.size(self.name)
+        return self._size
+    size = property(_get_size)
+
+    def _fetch(self, start, end):
+        """
+        Fetch at least from ``start`` to ``end``, stopping short of anything
+        that has already been fetched, and return it.
+        """
+        if start == self._last_end:
+            self._next_size = min(self._next_size * 2, self.max_block_size)
+        else:
+            self._next_size = self.block_size
+        limit = min([self.size] + [s for s, d in self._parts if s > start])
+        end = min(max(end, start + self._next_size), limit)
+        data = self.storage.read_range(self.name, start, end)
+        self.fetched += len(data)
+        self._last_end = start + len(data)
+        if data:
+            self._parts.append((start, data))
+            self._parts.sort()
+        return data
+
+    def _find(self, position):
+        for start, data in self._parts:
+            if start <= position < start + len(data):
+                return start, data
+        return None
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.position + size, self.size)
+        chunks = []
+        while self.position < end:
+            part = self._find(self.position)
+            if part is None:
+                data = self._fetch(self.position, end)
+                if not data:
+                    break
+                part = (self.position, data)
+            start, data = part
+            chunk = data[self.position - start:end - start]
+            chunks.append(chunk)
+            self.position += len(chunk)
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(offset, 0)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closed = True
+        self._parts = []
+
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 2**10), '')
@@ -3,13 +3,41 @@ from django import template
 from django.conf import settings
 from django.template.defaulttags import kwarg_re
 from django.utils.encoding import force_unicode, iri_to_uri
-from cuddlybuddly.thumbnail.main import Thumbnail
+from django.utils.safestring import mark_safe
+from cuddlybuddly.thumbnail.formats import choose_format
+from cuddlybuddly.thumbnail.main import generate_many, parse_specs, \
+    Thumbnail
+from cuddlybuddly.thumbnail.views import get_url
 
 
 register = template.Library()
 
 
+def negotiate_format(context, kwargs):
+    """
+    Replace ``format='auto'`` with the best format the request's ``Accept``
+    header allows, if the request is in the context.
+    """
+    if kwargs.get('format') != 'auto':
+        return
+    request = context.get('request')
+    if request is not None:
+        kwargs['format'] = choose_format(request.META.get('HTTP_ACCEPT', ''))
+    if kwargs['format'] in ('auto', None):
+        del kwargs['format']
+
+
+def thumbnail_path(thumb):
+    placeholder = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_PLACEHOLDER', None)
+    if thumb.pending and placeholder is not None:
+        thumb = placeholder
+    thumb = force_unicode(thumb).replace(settings.MEDIA_ROOT, '')
+    return iri_to_uri('/'.join(thumb.strip('\\/').split(os.sep)))
+
+
 class ThumbnailNode(template.Node):
+    negotiate_format = True
+
     def __init__(self, source, width, height, dest=None, proc=None,
                  as_var=None, extra_args=[], **kwargs):
         self.image_source = template.Variable(source)
@@ -48,21 +76,46 @@ class ThumbnailNode(template.Node):
         kwargs = dict(
             [(k, v.resolve(context)) for k, v in self.extra_kwargs.items()]
         )
+        if self.negotiate_format:
+            negotiate_format(context, kwargs)
         try:
-            thumb = Thumbnail(*args, **kwargs)
+            thumb = self.get_path(*args, **kwargs)
         except:
             thumb = ''
-        else:
-            thumb = force_unicode(thumb).replace(settings.MEDIA_ROOT, '')
-            thumb = iri_to_uri('/'.join(thumb.strip('\\/').split(os.sep)))
         if self.as_var:
             context[self.as_var] = thumb
             return ''
         else:
             return thumb
 
+    def get_path(self, *args, **kwargs):
+        return thumbnail_path(Thumbnail(*args, **kwargs))
+
+
+class ThumbnailURLNode(ThumbnailNode):
+    # Left to the view, which sees the Accept header of the image's request.
+    negotiate_format = False
+
+    def get_path(self, *args, **kwargs):
+        return get_url(*args, **kwargs)
+
+
+class ThumbnailSizeNode(ThumbnailNode):
+    def render(self, context):
+        size = super(ThumbnailSizeNode, self).render(context)
+        if not size:
+            return ''
+        return mark_safe('width="%(width)s" height="%(height)s"' % size)
+
+    def get_path(self, *args, **kwargs):
+        kwargs['generate'] = False
+        dimensions = Thumbnail(*args, **kwargs).dimensions
+        if dimensions is None:
+            return ''
+        return {'width': dimensions[0], 'height': dimensions[1]}
+
 
-def do_thumbnail(parser, token):
+def do_thumbnail(parser, token, node=ThumbnailNode, takes_dest=True):
     """
     Creates a thumbnail if needed and displays its url.
 
@@ -79,6 +132,13 @@ def do_thumbnail(parser, token):
         {% thumbnail source width height proc=custom option1=var option2='str' %}
 
     Source and destination can be a file like object or a path as a string.
+
+    Passing ``background=1`` queues the thumbnail to be generated outside of
+    the request and returns its path straight away.
+
+    Tags built on this one that don't take a destination pass
+    ``takes_dest=False`` so that the argument after the height is the
+    processor.
     """
 
     split_token = token.split_contents()
@@ -127,10 +187,116 @@ def do_thumbnail(parser, token):
                 % split_token[0]
             )
 
+    if not takes_dest and len(args) > 3:
+        args.insert(3, 'None')
     if len(args) > 5:
         kwargs['extra_args'] = args[5:]
         args = args[0:5]
-    return ThumbnailNode(*args, **kwargs)
+    return node(*args, **kwargs)
 
 
 do_thumbnail = register.tag('thumbnail', do_thumbnail)
+
+
+def do_thumbnail_url(parser, token):
+    """
+    Displays the url of a view that creates the thumbnail the first time it's
+    requested, so the page can be rendered without waiting for it.
+
+    Usage::
+
+        <img src="{% thumbnail_url source width height [processor] %}" alt="" />
+
+    Takes the same arguments as ``thumbnail`` except for a destination, and
+    the source must be a path or a model's file field.
+    """
+    return do_thumbnail(parser, token, ThumbnailURLNode, takes_dest=False)
+
+
+do_thumbnail_url = register.tag('thumbnail_url', do_thumbnail_url)
+
+
+def do_thumbnail_size(parser, token):
+    """
+    Displays the width and height of a thumbnail as attributes for an
+    ``img`` tag, without generating it or reading more of the source than
+    its header.
+
+    Usage::
+
+        <img src="..." {% thumbnail_size source width height [processor] %} alt="" />
+        {% thumbnail_size source width height as size %}{{ size.width }}
+
+    Takes the same arguments as ``thumbnail`` except for a destination.
+    Nothing is displayed if the processor can't tell the size without
+    generating the thumbnail.
+    """
+    return do_thumbnail(parser, token, ThumbnailSizeNode, takes_dest=False)
+
+
+do_thumbnail_size = register.tag('thumbnail_size', do_thumbnail_size)
+
+
+class ThumbnailsNode(template.Node):
+    def __init__(self, source, specs, as_var, **kwargs):
+        self.image_source = template.Variable(source)
+        self.specs = template.Variable(specs)
+        self.as_var = as_var
+        self.extra_kwargs = dict(
+            [(k, template.Variable(v)) for k, v in kwargs.items()]
+        )
+
+    def render(self, context):
+        kwargs = dict(
+            [(k, v.resolve(context)) for k, v in self.extra_kwargs.items()]
+        )
+        negotiate_format(context, kwargs)
+        specs = []
+        try:
+            specs = parse_specs(self.specs.resolve(context))
+            thumbs = generate_many(self.image_source.resolve(context), specs,
+                                   **kwargs)
+        except:
+            thumbs = [''] * len(specs)
+        else:
+            thumbs = [thumbnail_path(thumb) for thumb in thumbs]
+        context[self.as_var] = thumbs
+        return ''
+
+
+def do_thumbnails(parser, token):
+    """
+    Creates several thumbnails of the same source, only reading and decoding
+    it once, and puts a list of their urls into a variable.
+
+    Usage::
+
+        {% thumbnails source "80x60 160x120:crop 320x240:crop:quality=50" as thumbs %}
+        {% thumbnails source specs quality=50 as thumbs %}
+
+    Each spec is a width and height optionally followed by a processor and
+    its options. Specs can also be a list of ``(width, height, processor,
+    options)`` tuples and any keyword arguments are used for every thumbnail.
+    """
+
+    split_token = token.split_contents()
+    if len(split_token) < 5 or split_token[-2] != 'as':
+        raise template.TemplateSyntaxError(
+            "%r tag requires a source, specs and a variable name to attach to" \
+            % split_token[0]
+        )
+    kwargs = {}
+    for v in split_token[3:-2]:
+        match = kwarg_re.match(v)
+        if not match or not match.group(1):
+            raise template.TemplateSyntaxError(
+                "Malformed arguments to %r tag" % split_token[0]
+            )
+        name, value = match.groups()
+        # Python < 2.7 does not accept unicode keywords.
+        kwargs[name.encode('utf-8')] = value
+    return ThumbnailsNode(split_token[1], split_token[2], split_token[-1],
+                          **kwargs)
+
+
+do_thumbnails = register.tag('thumbnails', do_thumbnails)
@@ -1,25 +1,63 @@
 import hashlib
 import os
+import shutil
+import tempfile
+import threading
+import time
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 try:
-    from PIL import Image
+    from PIL import Image, ImageChops, ImageOps, ImageStat
 except ImportError:
-    import Image
+    import Image, ImageChops, ImageOps, ImageStat
 from django.conf import settings
 from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
+from django.core.files.storage import default_storage, \
+    FileSystemStorage, Storage
+from django.core.management import call_command
+from django.core.signing import BadSignature
 from django.db.models.loading import load_app
 from django.template import Context, Template, TemplateSyntaxError
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import RequestFactory
 from django.utils.encoding import force_unicode, smart_str
 from cuddlybuddly import thumbnail
 from cuddlybuddly.thumbnail import CropToFitProcessor, ResizeProcessor
-from cuddlybuddly.thumbnail.exceptions import ThumbnailException
-from cuddlybuddly.thumbnail.main import build_thumbnail_name, Thumbnail
+from cuddlybuddly.thumbnail import background, benchmark
+from cuddlybuddly.thumbnail.background import get_queue, ThreadQueue
+from cuddlybuddly.thumbnail.benchmark import compare, make_image, \
+    MemoryStorage, RangeMemoryStorage, STAGES, time_stages
+from cuddlybuddly.thumbnail.exceptions import ExecutorFull, \
+    ThumbnailException
+from cuddlybuddly.thumbnail.executors import ProcessExecutor, \
+    SerialExecutor, ThreadExecutor
+from cuddlybuddly.thumbnail.formats import can_save, choose_format, \
+    get_mime_type
+from cuddlybuddly.thumbnail.freshness import get_freshness_cache, invalidate
+from cuddlybuddly.thumbnail.locks import acquire as acquire_lock, \
+    CacheLockBackend, FileLockBackend
+from cuddlybuddly.thumbnail.main import build_thumbnail_name, \
+    generate_many, get_buffer, hash_file, parse_specs, resolve_many, \
+    Thumbnail, thumbnail_async
+from cuddlybuddly.thumbnail import main
+from cuddlybuddly.thumbnail import metadata as metadata_module
+from cuddlybuddly.thumbnail.metadata import CacheBackend, FileBackend, \
+    SQLiteBackend
+from cuddlybuddly.thumbnail.probe import probe
+from cuddlybuddly.thumbnail.sourcecache import get_source_cache, \
+    SourceCache
+from cuddlybuddly.thumbnail.signals import thumbnail_checked, \
+    thumbnail_generated
+from cuddlybuddly.thumbnail.spec import dumps, get_key, loads, serialize
+from cuddlybuddly.thumbnail import storage as storage_module
+from cuddlybuddly.thumbnail.storage import get_dest_storage, \
+    get_modified_times, get_source_storage, get_storage, open_source, \
+    RangeFile, save_overwrite
 from cuddlybuddly.thumbnail.tests.cbtfakeapp.models import FakeImage
+from cuddlybuddly.thumbnail.views import get_url, serve
 
 try:
     set
@@ -177,11 +215,53 @@ class BuildThumbnailNameTests(TestCase):
             self.assertEqual(build_thumbnail_name(*args),
                              os.path.join(test[1][0], test[1][1], test[2]))
 
+    def test_extra_options(self):
+        class OptionProcessor(ResizeProcessor):
+            my_option = 50
+        settings.CUDDLYBUDDLY_THUMBNAIL_BASEDIR = ''
+        settings.CUDDLYBUDDLY_THUMBNAIL_SUBDIR = ''
+        name = build_thumbnail_name('image.jpg', 50, 50, OptionProcessor())
+        self.assertEqual(name, 'image_jpg_50x50_q85.jpg')
+        name = build_thumbnail_name('image.jpg', 50, 50,
+                                    OptionProcessor(quality=50, unused=1))
+        self.assertEqual(name, 'image_jpg_50x50_q50.jpg')
+        name = build_thumbnail_name('image.jpg', 50, 50,
+                                    OptionProcessor(my_option=75))
+        key = get_key(OptionProcessor(), 50, 50, {'my_option': 75})
+        self.assertEqual(name, 'image_jpg_50x50_q85_%s.jpg' % key)
+        self.assertNotEqual(
+            build_thumbnail_name('image.jpg', 50, 50,
+                                 OptionProcessor(my_option=76)),
+            name
+        )
+
     def tearDown(self):
         for setting, value in self.settings_backup.iteritems():
             setattr(settings, setting, value)
 
 
+class SpecTests(TestCase):
+    def test_serialize(self):
+        self.assertEqual(
+            serialize(ResizeProcessor(upscale=1, quality=50), 80, '60'),
+            serialize(ResizeProcessor(quality=50, upscale=1), 80, 60)
+        )
+        self.assertNotEqual(serialize(ResizeProcessor(), 80, 60),
+                            serialize(CropToFitProcessor(), 80, 60))
+        self.assertEqual(len(get_key(ResizeProcessor(), 80, 60)), 10)
+        self.assertNotEqual(get_key(ResizeProcessor(), 80, 60),
+                            get_key(ResizeProcessor(quality=50), 80, 60))
+
+    def test_signing(self):
+        value = {'w': 80, 'h': 60, 'o': {'quality': 50}}
+        signed = dumps(value, salt='a.jpg')
+        self.assertEqual(signed, dumps(value, salt='a.jpg'))
+        self.assertEqual(loads(signed, salt='a.jpg'), value)
+        self.assertRaises(BadSignature, loads, signed, 'b.jpg')
+        self.assertRaises(BadSignature, loads, signed[:-1], 'a.jpg')
+        self.assertRaises(BadSignature, loads, 'nosignature')
+
+
 class ThumbnailTests(BaseTest):
     def test_bad_init_values(self):
         self.assertRaises(ThumbnailException, Thumbnail, '', 'a', 1)
@@ -212,6 +292,98 @@ class ThumbnailTests(BaseTest):
         self.cache_to_delete.add(cache)
         file.close()
 
+    def test_generate_from_file_object_with_content_key(self):
+        file = default_storage.open(PIC_NAME, 'rb')
+        source = StringIO(file.read())
+        file.close()
+        dest = os.path.join(
+            self.MEDIA_MIDDLE,
+            'cb-thumbnail-test_jpg_%s' % '40x30_q85.jpg'
+        )
+        thumb = Thumbnail(source, 40, 30, dest=dest, content_key='"etag"')
+        self.verify_thumb(thumb, 40, 30, '40x30_q85.jpg')
+        cache = os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5('"etag"').hexdigest()
+        )
+        self.assert_(os.path.exists(cache), 'Does not exist: %s' % cache)
+        self.cache_to_delete.add(cache)
+
+    def test_hash_file(self):
+        class File(object):
+            def __init__(self, data):
+                self.file = StringIO(data)
+                self.reads = []
+
+            def read(self, size=-1):
+                self.reads.append(size)
+                return self.file.read(size)
+
+            def tell(self):
+                return self.file.tell()
+
+            def seek(self, position):
+                self.file.seek(position)
+
+        data = 'x' * (200 * 2**10)
+        file = File(data)
+        file.seek(10)
+        key = hash_file(file)
+        self.assertEqual(file.tell(), 10)
+        self.assert_(-1 not in file.reads)
+        self.assertEqual(key, hash_file(File(data)))
+        self.assertNotEqual(key, hash_file(File(data + 'x')))
+
+    def test_draft_decoding(self):
+        decoded = []
+        class RecordingProcessor(ResizeProcessor):
+            def generate_thumbnail(self, image, width, height):
+                decoded.append(image.size)
+                return super(RecordingProcessor, self).generate_thumbnail(
+                    image, width, height
+                )
+        thumbnail.register_processor('recording', RecordingProcessor)
+
+        source = 'cb-thumbnail-test-large.jpg'
+        file = StringIO()
+        Image.new('RGB', (2401, 1799)).save(file, 'JPEG')
+        default_storage.save(source, ContentFile(file.getvalue()))
+        self.images_to_delete.add(source)
+        file.close()
+        self.cache_to_delete.add(os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5(smart_str(source)).hexdigest()
+        ))
+
+        dest = StringIO()
+        Thumbnail(source, 150, 150, dest=dest, proc='recording')
+        self.assertEqual(decoded, [(301, 225)])
+        self.verify_thumb(None, 150, 112, dest)
+        dest.close()
+
+    def test_reuses_buffers(self):
+        buffer = get_buffer()
+        buffer.write('data')
+        self.assert_(get_buffer() is buffer)
+        self.assertEqual(buffer.getvalue(), '')
+        buffer.close()
+        self.assert_(get_buffer() is not buffer)
+
+    def test_generate_from_unseekable_file_object(self):
+        class File(object):
+            def __init__(self, file):
+                self.file = file
+
+            def read(self, size=-1):
+                return self.file.read(size)
+
+        file = default_storage.open(PIC_NAME, 'rb')
+        dest = StringIO()
+        thumb = Thumbnail(File(file), 40, 30, dest=dest)
+        self.verify_thumb(thumb, 40, 30, dest)
+        file.close()
+        dest.close()
+
     def test_generate_to_string(self):
         dest = os.path.join(self.MEDIA_MIDDLE,
                             'cb-thumbnail-test_jpg_string.jpg')
@@ -336,6 +508,679 @@ class ThumbnailTests(BaseTest):
         self.assert_(source_cache_mtime2 <= thumb2_cache)
 
 
+class GenerateManyTests(BaseTest):
+    def test_generate_many(self):
+        processed = []
+        class RecordingProcessor(ResizeProcessor):
+            def generate_thumbnail(self, image, width, height):
+                processed.append(((width, height), image.size))
+                return super(RecordingProcessor, self).generate_thumbnail(
+                    image, width, height
+                )
+        thumbnail.register_processor('recording', RecordingProcessor)
+        class RecordingCropProcessor(CropToFitProcessor):
+            def generate_thumbnail(self, image, width, height):
+                processed.append(((width, height), image.size))
+                return super(RecordingCropProcessor, self).generate_thumbnail(
+                    image, width, height
+                )
+        thumbnail.register_processor('recordingcrop', RecordingCropProcessor)
+
+        thumbs = generate_many(RELATIVE_PIC_NAME, (
+            (40, 30, 'recording'),
+            (400, 300, 'recording'),
+            (90, 90, 'recordingcrop', {'quality': 50}),
+            (300, 300, 'recordingcrop'),
+            (600, 450, 'recording'),
+        ))
+        self.verify_thumb(thumbs[0], 40, 30, '40x30_q85.jpg')
+        self.verify_thumb(thumbs[1], 400, 300, '400x300_q85.jpg')
+        self.verify_thumb(thumbs[2], 90, 90, '90x90_q50_ctf.jpg')
+        self.verify_thumb(thumbs[3], 300, 300, '300x300_q85_ctf.jpg')
+        self.verify_thumb(thumbs[4], 600, 450, '600x450_q85.jpg')
+        self.assertEqual(processed, [
+            ((600, 450), (800, 600)),
+            ((400, 300), (800, 600)),
+            ((300, 300), (800, 600)),
+            ((90, 90), (400, 300)),
+            ((40, 30), (400, 300)),
+        ])
+
+        del processed[:]
+        generate_many(RELATIVE_PIC_NAME, ((40, 30, 'recording'),))
+        self.assertEqual(processed, [])
+
+    def test_failure(self):
+        failing = [(400, 300)]
+        class FlakyProcessor(ResizeProcessor):
+            def generate_thumbnail(self, image, width, height):
+                if (width, height) in failing:
+                    raise IOError('Flaky')
+                return super(FlakyProcessor, self).generate_thumbnail(
+                    image, width, height
+                )
+        thumbnail.register_processor('flaky', FlakyProcessor)
+        specs = ((600, 450, 'flaky'), (400, 300, 'flaky'), (40, 30, 'flaky'))
+        self.assertRaises(IOError, generate_many, RELATIVE_PIC_NAME, specs)
+        for width, height in ((600, 450), (400, 300), (40, 30)):
+            self.images_to_delete.add(os.path.join(
+                self.MEDIA_MIDDLE,
+                'cb-thumbnail-test_jpg_%sx%s_q85.jpg' % (width, height)
+            ))
+
+        # Neither the thumbnail that failed nor the one that was never got to
+        # are left looking fresh.
+        del failing[:]
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 40, 30, proc='flaky')
+        self.assert_(thumb.generated)
+        self.verify_thumb(thumb, 40, 30, '40x30_q85.jpg')
+        thumbs = generate_many(RELATIVE_PIC_NAME, specs)
+        self.assertEqual([t.generated for t in thumbs], [False, True, False])
+        self.verify_thumb(thumbs[0], 600, 450, '600x450_q85.jpg')
+        self.verify_thumb(thumbs[1], 400, 300, '400x300_q85.jpg')
+
+    def test_generated_while_waiting(self):
+        # The thumbnail is generated by someone else between being found
+        # stale and its lock being taken.
+        def generating_acquire(name, *args, **kwargs):
+            main.acquire_lock = acquire_lock
+            Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+            return acquire_lock(name, *args, **kwargs)
+        main.acquire_lock = generating_acquire
+        try:
+            thumbs = generate_many(RELATIVE_PIC_NAME, ((80, 60),))
+        finally:
+            main.acquire_lock = acquire_lock
+        self.assert_(not thumbs[0].generated)
+        self.assert_(not thumbs[0].pending)
+        self.verify_thumb(thumbs[0], 80, 60, '80x60_q85.jpg')
+
+    def test_template(self):
+        template = '{% thumbnails "'+RELATIVE_PIC_NAME+'" "80x60 40x30:crop:quality=50" as thumbs %}{{ thumbs.0 }} {{ thumbs.1 }}'
+        paths = []
+        for image in ('80x60_q85.jpg', '40x30_q50_ctf.jpg'):
+            path = os.path.join(self.MEDIA_MIDDLE,
+                                'cb-thumbnail-test_jpg_%s' % image)
+            self.images_to_delete.add(path)
+            self.cache_to_delete.add(os.path.join(
+                settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                hashlib.md5(smart_str(path)).hexdigest()
+            ))
+            paths.append(path.replace('\\', '/'))
+        self.assertEqual(self.render_template(template), ' '.join(paths))
+        self.assertRaises(TemplateSyntaxError, self.render_template,
+                          '{% thumbnails "a" "80x60" %}')
+
+    def test_parse_specs(self):
+        self.assertEqual(
+            parse_specs('80x60 160x120:crop 320x240::quality=50,upscale=1'),
+            [('80', '60', None, {}), ('160', '120', 'crop', {}),
+             ('320', '240', None, {'quality': 50, 'upscale': 1})]
+        )
+        specs = [(80, 60)]
+        self.assert_(parse_specs(specs) is specs)
+
+
+class BackgroundTests(BaseTest):
+    def setUp(self):
+        super(BackgroundTests, self).setUp()
+        # Workers aren't started until start() so that they can't finish a
+        # thumbnail before it has been checked for being pending.
+        self.queue_backup = background._queue
+        background._queue = ThreadQueue(workers=0)
+
+    def tearDown(self):
+        background._queue.join()
+        background._queue = self.queue_backup
+        super(BackgroundTests, self).tearDown()
+
+    def start(self):
+        queue = get_queue()
+        queue.workers = 1
+        queue._start_workers()
+        queue.join()
+
+    def test_generate_in_background(self):
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, background=True)
+        self.assert_(thumb.pending)
+        self.start()
+        self.assert_(not thumb.pending)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+
+    def test_skips_thumbnails_generated_in_the_meantime(self):
+        generated = []
+        def on_generated(sender, thumbnail, **kwargs):
+            generated.append(thumbnail)
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, background=True)
+        self.assert_(thumb.pending)
+        other = Thumbnail(RELATIVE_PIC_NAME, 80, 60, generate=False)
+        other._get_metadata_keys()
+        other._generate()
+        thumbnail_generated.connect(on_generated)
+        try:
+            self.start()
+        finally:
+            thumbnail_generated.disconnect(on_generated)
+        self.assertEqual(generated, [])
+        self.assert_(not thumb.generated)
+        self.assert_(not thumb.pending)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+
+    def test_claimed_thumbnails_stay_pending(self):
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, background=True)
+        self.assert_(thumb.pending)
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, background=True)
+        self.assert_(thumb.pending)
+        self.assert_(not default_storage.exists(force_unicode(thumb)))
+
+        # Losing the queue, such as on a restart, leaves only the claim.
+        background._queue = ThreadQueue(workers=0)
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, background=True)
+        self.assert_(thumb.pending)
+        self.start()
+        self.assert_(not thumb.pending)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+
+    def test_file_like_sources_are_not_deferred(self):
+        file = default_storage.open(PIC_NAME, 'rb')
+        dest = os.path.join(
+            self.MEDIA_MIDDLE,
+            'cb-thumbnail-test_jpg_%s' % '40x30_q85.jpg'
+        )
+        thumb = Thumbnail(file, 40, 30, dest=dest, background=True)
+        self.assert_(not thumb.pending)
+        self.verify_thumb(thumb, 40, 30, '40x30_q85.jpg')
+        cache = os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5(force_unicode(file)).hexdigest()
+        )
+        self.cache_to_delete.add(cache)
+        file.close()
+
+    def test_deduplicates_by_destination(self):
+        class FakeThumbnail(object):
+            dest = 'cb-thumbnail-test_jpg_fake.jpg'
+        queue = ThreadQueue(workers=0)
+        self.assert_(queue.put(FakeThumbnail()))
+        self.assert_(not queue.put(FakeThumbnail()))
+
+    def test_placeholder(self):
+        placeholder = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_PLACEHOLDER',
+                              None)
+        settings.CUDDLYBUDDLY_THUMBNAIL_PLACEHOLDER = 'placeholder.png'
+        try:
+            template = '{% thumbnail "'+RELATIVE_PIC_NAME+'" 40 30 background=1 %}'
+            self.assertEqual(self.render_template(template), 'placeholder.png')
+            self.start()
+            path = os.path.join(
+                self.MEDIA_MIDDLE, 'cb-thumbnail-test_jpg_40x30_q85.jpg'
+            )
+            self.assertEqual(self.render_template(template),
+                             path.replace('\\', '/'))
+            self.images_to_delete.add(path)
+            self.cache_to_delete.add(os.path.join(
+                settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                hashlib.md5(smart_str(path)).hexdigest()
+            ))
+        finally:
+            settings.CUDDLYBUDDLY_THUMBNAIL_PLACEHOLDER = placeholder
+
+
+class FreshnessTests(BaseTest):
+    def setUp(self):
+        super(FreshnessTests, self).setUp()
+        self.freshness_backup = (
+            getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_TTL', 0),
+            getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_CACHE', None),
+        )
+        settings.CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_TTL = 60
+        settings.CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_CACHE = None
+        invalidate()
+
+    def tearDown(self):
+        invalidate()
+        settings.CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_TTL = self.freshness_backup[0]
+        settings.CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_CACHE = \
+            self.freshness_backup[1]
+        super(FreshnessTests, self).tearDown()
+
+    def forget_thumb(self, image):
+        image = os.path.join(
+            self.MEDIA_MIDDLE,
+            'cb-thumbnail-test_jpg_%s' % image
+        )
+        default_storage.delete(image)
+        os.remove(os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5(smart_str(image)).hexdigest()
+        ))
+        return image
+
+    def test_remembers_fresh_thumbnails(self):
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+        image = self.forget_thumb('80x60_q85.jpg')
+        Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.assert_(not default_storage.exists(image))
+
+        invalidate(RELATIVE_PIC_NAME)
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+
+    def test_processor_options_are_part_of_the_key(self):
+        dest = os.path.join(self.MEDIA_MIDDLE,
+                            'cb-thumbnail-test_jpg_options.jpg')
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, dest=dest)
+        self.verify_thumb(thumb, 80, 60, 'options.jpg')
+        self.forget_thumb('options.jpg')
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, dest=dest, quality=50)
+        self.verify_thumb(thumb, 80, 60, 'options.jpg')
+
+    def test_disabled(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_TTL = 0
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+        self.forget_thumb('80x60_q85.jpg')
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+
+    def test_shared_cache(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_FRESHNESS_CACHE = 'default'
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+        image = self.forget_thumb('80x60_q85.jpg')
+        # Only the shared layer is left to say it's fresh.
+        get_freshness_cache().entries.clear()
+        Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.assert_(not default_storage.exists(image))
+
+        get_freshness_cache().entries.clear()
+        invalidate(RELATIVE_PIC_NAME)
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+
+
+class SignalsTests(BaseTest):
+    def setUp(self):
+        super(SignalsTests, self).setUp()
+        self.checked = []
+        self.generated = []
+        thumbnail_checked.connect(self.on_checked)
+        thumbnail_generated.connect(self.on_generated)
+
+    def tearDown(self):
+        thumbnail_checked.disconnect(self.on_checked)
+        thumbnail_generated.disconnect(self.on_generated)
+        super(SignalsTests, self).tearDown()
+
+    def on_checked(self, sender, **kwargs):
+        self.checked.append(kwargs)
+
+    def on_generated(self, sender, **kwargs):
+        self.generated.append(kwargs)
+
+    def test_signals(self):
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+        # Checked again once the lock to generate it has been taken.
+        self.assertEqual(len(self.checked), 2)
+        self.assertEqual(self.checked[1]['stale'], True)
+        self.assert_(self.checked[0]['thumbnail'] is thumb)
+        self.assertEqual(self.checked[0]['stale'], True)
+        self.assertEqual(self.checked[0]['checked_by'], 'metadata')
+        self.assertEqual(self.checked[0]['cache_hit'], False)
+        self.assertEqual(len(self.generated), 1)
+        self.assertEqual(sorted(self.generated[0]['timings'].keys()),
+                         ['decode', 'encode', 'open', 'process', 'store'])
+        self.assertEqual(self.generated[0]['bytes_read'],
+                         default_storage.size(RELATIVE_PIC_NAME))
+        self.assertEqual(self.generated[0]['bytes_written'],
+                         default_storage.size(force_unicode(thumb)))
+
+        Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        self.assertEqual(len(self.checked), 3)
+        self.assertEqual(self.checked[2]['stale'], False)
+        self.assertEqual(self.checked[2]['cache_hit'], True)
+        self.assertEqual(len(self.generated), 1)
+
+    def test_file_like_source(self):
+        file = default_storage.open(RELATIVE_PIC_NAME, 'rb')
+        dest = StringIO()
+        Thumbnail(file, 80, 60, dest=dest)
+        self.assertEqual(self.generated[0]['bytes_read'], file.size)
+        self.assertEqual(self.generated[0]['bytes_written'],
+                         len(dest.getvalue()))
+        file.close()
+
+
+class LockTests(BaseTest):
+    def setUp(self):
+        super(LockTests, self).setUp()
+        self.backend_backup = getattr(
+            settings, 'CUDDLYBUDDLY_THUMBNAIL_LOCK_BACKEND', None
+        )
+        self.lock_dir = os.path.join(settings.MEDIA_ROOT, 'cbttestlocks')
+        settings.CUDDLYBUDDLY_THUMBNAIL_LOCK_DIR = self.lock_dir
+
+    def tearDown(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_LOCK_BACKEND = self.backend_backup
+        del settings.CUDDLYBUDDLY_THUMBNAIL_LOCK_DIR
+        shutil.rmtree(self.lock_dir, ignore_errors=True)
+        super(LockTests, self).tearDown()
+
+    def test_in_process(self):
+        lock = acquire_lock('a')
+        self.assert_(not lock.waited)
+        self.assertEqual(acquire_lock('a', wait=0), None)
+        acquire_lock('b', wait=0).release()
+
+        def release():
+            time.sleep(0.1)
+            lock.release()
+        thread = threading.Thread(target=release)
+        thread.start()
+        other = acquire_lock('a', wait=5)
+        thread.join()
+        self.assert_(other.waited)
+        other.release()
+
+    def test_backends(self):
+        for backend in (FileLockBackend(), CacheLockBackend()):
+            token = backend.acquire('abc', 60)
+            self.assertNotEqual(token, None)
+            self.assertEqual(backend.acquire('abc', 60), None)
+            backend.release('abc', token)
+            backend.release('abc', backend.acquire('abc', 60))
+
+    def test_different_keys(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_LOCK_BACKEND = \
+            'cuddlybuddly.thumbnail.locks.FileLockBackend'
+        backend = FileLockBackend()
+        # Keys starting the same way share a directory but not a lock.
+        tokens = [backend.acquire(key, 60) for key in ('abc', 'abd')]
+        self.assert_(None not in tokens)
+        self.assertEqual(backend.acquire('abd', 60), None)
+        for key, token in zip(('abc', 'abd'), tokens):
+            backend.release(key, token)
+        self.assertEqual(os.listdir(os.path.join(self.lock_dir, 'ab')), [])
+
+        locks = [acquire_lock(name, wait=0) for name in ('a', 'b')]
+        self.assert_(None not in locks)
+        for lock in locks:
+            lock.release()
+
+        thumbs = generate_many(RELATIVE_PIC_NAME, [(14, 14), (25, 25)])
+        for thumb in thumbs:
+            self.assert_(thumb.generated)
+            self.assert_(not thumb.pending)
+            width, height = thumb.dimensions
+            self.verify_thumb(thumb, width, height,
+                              '%sx%s_q85.jpg' % (thumb.width, thumb.height))
+
+    def test_backend_is_used(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_LOCK_BACKEND = \
+            'cuddlybuddly.thumbnail.locks.FileLockBackend'
+        lock = acquire_lock('a')
+        token = FileLockBackend().acquire(lock.key, 60)
+        self.assertEqual(token, None)
+        lock.release()
+
+    def test_single_flight(self):
+        generated = []
+        def on_generated(sender, thumbnail, **kwargs):
+            generated.append(thumbnail)
+        def on_checked(sender, **kwargs):
+            # Let every thread find the thumbnail stale before any claims it.
+            time.sleep(0.1)
+        thumbnail_generated.connect(on_generated)
+        thumbnail_checked.connect(on_checked)
+        try:
+            threads = [threading.Thread(target=Thumbnail,
+                                        args=(RELATIVE_PIC_NAME, 80, 60))
+                       for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            thumbnail_generated.disconnect(on_generated)
+            thumbnail_checked.disconnect(on_checked)
+        self.assertEqual(len(generated), 1)
+        self.verify_thumb(generated[0], 80, 60, '80x60_q85.jpg')
+
+    def test_waits_for_claimed_thumbnails(self):
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, generate=False)
+        self.assert_(thumb.is_stale())
+        lock = acquire_lock(thumb.dest)
+        thumb._claim()
+        others = []
+        thread = threading.Thread(target=lambda: others.append(
+            Thumbnail(RELATIVE_PIC_NAME, 80, 60)
+        ))
+        try:
+            thread.start()
+            thread.join(0.2)
+            self.assert_(thread.isAlive())
+            thumb._generate()
+        finally:
+            lock.release()
+        thread.join(5)
+        other = others[0]
+        self.assert_(not other.generated)
+        self.assert_(not other.pending)
+        self.verify_thumb(other, 80, 60, '80x60_q85.jpg')
+
+    def test_generate_many_skips_locked(self):
+        dest = os.path.join(self.MEDIA_MIDDLE,
+                            'cb-thumbnail-test_jpg_80x60_q85.jpg')
+        lock = acquire_lock(dest)
+        try:
+            thumbs = generate_many(RELATIVE_PIC_NAME, [(80, 60), (40, 30)])
+        finally:
+            lock.release()
+        self.assert_(thumbs[0].pending)
+        self.assert_(not default_storage.exists(dest))
+        self.verify_thumb(thumbs[1], 40, 30, '40x30_q85.jpg')
+
+
+class MetadataTests(BaseTest):
+    def setUp(self):
+        super(MetadataTests, self).setUp()
+        self.backend_backup = getattr(
+            settings, 'CUDDLYBUDDLY_THUMBNAIL_METADATA_BACKEND', None
+        )
+        self.db = os.path.join(settings.MEDIA_ROOT, 'cbttestmetadata.sqlite3')
+
+    def tearDown(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_METADATA_BACKEND = self.backend_backup
+        connection = metadata_module._connections.__dict__.get(
+            'sqlite', {}
+        ).pop(self.db, None)
+        if connection is not None:
+            connection.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db + suffix):
+                os.remove(self.db + suffix)
+        super(MetadataTests, self).tearDown()
+
+    def check_backend(self, backend):
+        self.assertEqual(backend.get('a'), None)
+        record = backend.set('a')
+        self.assertEqual(backend.get('a'), record)
+        self.assertEqual(record['width'], None)
+        record = backend.set('b', width=80, height=60, format='JPEG')
+        self.assertEqual(backend.get('b'), record)
+        self.assertEqual((record['width'], record['height'], record['format']),
+                         (80, 60, 'JPEG'))
+        self.assertEqual(set(backend.get_many(['a', 'b', 'c']).keys()),
+                         set(['a', 'b']))
+        backend.delete_many(['a', 'b'])
+        self.assertEqual(backend.get_many(['a', 'b']), {})
+
+    def test_keys_are_kept(self):
+        class CountingFile(object):
+            def __init__(self, data):
+                self.file = StringIO(data)
+                self.reads = 0
+
+            def read(self, size=-1):
+                self.reads += 1
+                return self.file.read(size)
+
+            def tell(self):
+                return self.file.tell()
+
+            def seek(self, position):
+                self.file.seek(position)
+
+        source = CountingFile(default_storage.open(PIC_NAME).read())
+        dest = os.path.join(settings.MEDIA_ROOT, 'cbttestkeys.jpg')
+        thumb = Thumbnail(source, 80, 60, dest=dest, generate=False)
+        keys = thumb._get_metadata_keys()
+        reads = source.reads
+        self.assert_(reads)
+        self.assertEqual(thumb._get_metadata_keys(), keys)
+        self.assertEqual(source.reads, reads)
+
+    def test_file_backend(self):
+        backend = FileBackend()
+        for key in ('a', 'b'):
+            self.cache_to_delete.add(os.path.join(backend.location, key))
+        self.check_backend(backend)
+
+    def test_sqlite_backend(self):
+        self.check_backend(SQLiteBackend(self.db))
+
+    def test_cache_backend(self):
+        self.check_backend(CacheBackend('default'))
+
+    def test_generate_records_dimensions(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_METADATA_BACKEND = \
+            'cuddlybuddly.thumbnail.metadata.SQLiteBackend'
+        settings.CUDDLYBUDDLY_THUMBNAIL_METADATA_DB = self.db
+        try:
+            thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 80)
+        finally:
+            del settings.CUDDLYBUDDLY_THUMBNAIL_METADATA_DB
+        path = os.path.join(self.MEDIA_MIDDLE,
+                            'cb-thumbnail-test_jpg_80x80_q85.jpg')
+        self.images_to_delete.add(path)
+        self.assertEqual(force_unicode(thumb), path)
+        record = SQLiteBackend(self.db).get(
+            hashlib.md5(smart_str(path)).hexdigest()
+        )
+        self.assertEqual((record['width'], record['height'], record['format']),
+                         (80, 60, 'JPEG'))
+        self.assert_(not os.path.exists(os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5(smart_str(path)).hexdigest()
+        )))
+
+
+class ProbeTests(BaseTest):
+    def setUp(self):
+        super(ProbeTests, self).setUp()
+        source = hashlib.md5(smart_str(RELATIVE_PIC_NAME)).hexdigest()
+        self.cache_to_delete.add(os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5(source + ':probe').hexdigest()
+        ))
+        self.probed = []
+        def counting_probe(source, storage=None):
+            self.probed.append(source)
+            return probe(source, storage)
+        main.probe = counting_probe
+
+    def tearDown(self):
+        main.probe = probe
+        super(ProbeTests, self).tearDown()
+
+    def test_probe(self):
+        self.assertEqual(probe(RELATIVE_PIC_NAME), PIC_SIZE + ('JPEG',))
+        file = default_storage.open(RELATIVE_PIC_NAME)
+        file.read(10)
+        self.assertEqual(probe(file), PIC_SIZE + ('JPEG',))
+        self.assertEqual(file.tell(), 10)
+        file.seek(0)
+        class Unseekable(object):
+            def __init__(self, data):
+                self.data = StringIO(data)
+                self.read_size = 0
+            def read(self, size=-1):
+                data = self.data.read(size)
+                self.read_size += len(data)
+                return data
+        data = StringIO()
+        make_image((1600, 1200), 'RGB').save(data, 'PNG')
+        unseekable = Unseekable(data.getvalue())
+        self.assertEqual(probe(unseekable), (1600, 1200, 'PNG'))
+        self.assert_(unseekable.read_size < len(data.getvalue()) / 10)
+        self.assertEqual(probe(Image.open(file)), PIC_SIZE + ('JPEG',))
+        file.close()
+        self.assertRaises(ThumbnailException, probe, ContentFile('not'))
+        self.assertRaises(ThumbnailException, probe, 'missing.jpg')
+
+        memory = MemoryStorage()
+        memory.save('a.gif', ContentFile(data.getvalue()))
+        wrapped = default_storage._wrapped
+        default_storage._wrapped = memory
+        try:
+            self.assertEqual(probe('a.gif'), (1600, 1200, 'PNG'))
+        finally:
+            default_storage._wrapped = wrapped
+
+    def test_dimensions(self):
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 80, generate=False)
+        self.assertEqual(thumb.dimensions, (80, 60))
+        self.assertEqual((thumb.width, thumb.height), (80, 80))
+        self.assert_(not default_storage.exists(thumb.dest))
+        self.assertEqual(thumb.url, default_storage.url(thumb.dest))
+        self.assertEqual(self.probed, [RELATIVE_PIC_NAME])
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 80, proc='crop',
+                          generate=False)
+        self.assertEqual(thumb.dimensions, (80, 80))
+        self.assertEqual(self.probed, [RELATIVE_PIC_NAME])
+
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 40, 40)
+        self.verify_thumb(thumb, 40, 30, '40x40_q85.jpg')
+        self.assertEqual(thumb.dimensions, (40, 30))
+        self.assertEqual(
+            Thumbnail(RELATIVE_PIC_NAME, 40, 40).dimensions, (40, 30)
+        )
+        self.assertEqual(self.probed, [RELATIVE_PIC_NAME])
+
+        cache = settings.CUDDLYBUDDLY_THUMBNAIL_CACHE
+        settings.CUDDLYBUDDLY_THUMBNAIL_CACHE = None
+        try:
+            thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 80, generate=False)
+            self.assertEqual(thumb.dimensions, (80, 60))
+        finally:
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE = cache
+        self.assertEqual(len(self.probed), 2)
+
+    def test_template(self):
+        self.assertEqual(
+            self.render_template('{% thumbnail_size "' + RELATIVE_PIC_NAME +
+                                 '" 80 80 %}'),
+            'width="80" height="60"'
+        )
+        self.assertEqual(
+            self.render_template('{% thumbnail_size "' + RELATIVE_PIC_NAME +
+                                 '" 80 80 proc="crop" as size %}'
+                                 '{{ size.width }}x{{ size.height }}'),
+            '80x80'
+        )
+        self.assertEqual(
+            self.render_template('{% thumbnail_size "' + RELATIVE_PIC_NAME +
+                                 '" 80 80 "crop" %}'),
+            'width="80" height="80"'
+        )
+        self.assertEqual(
+            self.render_template('{% thumbnail_size "missing.jpg" 80 80 %}'),
+            ''
+        )
+
+
 class TemplateTests(BaseTest):
     def test_bad_values(self):
         tests = (
@@ -437,6 +1282,182 @@ class TemplateTests(BaseTest):
         self.cache_to_delete.add(cache)
 
 
+class ViewTests(BaseTest):
+    def setUp(self):
+        super(ViewTests, self).setUp()
+        self.dest = os.path.join(self.MEDIA_MIDDLE,
+                                 'cb-thumbnail-test_jpg_80x60_q85_ctf.jpg')
+        self.images_to_delete.add(self.dest)
+        self.cache_to_delete.add(os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5(smart_str(self.dest)).hexdigest()
+        ))
+        self.url = get_url(RELATIVE_PIC_NAME, 80, 60, proc='crop')
+
+    def test_serve(self):
+        self.assert_(self.url.startswith('/thumbs/'))
+        self.assert_(self.url.endswith('/' + RELATIVE_PIC_NAME))
+        self.assert_(not default_storage.exists(self.dest))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=86400')
+        self.assertEqual(Image.open(StringIO(response.content)).size,
+                         (80, 60))
+        self.assert_(default_storage.exists(self.dest))
+
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+        )
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_options_are_signed(self):
+        self.assertEqual(get_url(RELATIVE_PIC_NAME, 80, 60, proc='crop'),
+                         self.url)
+        request = RequestFactory().get(self.url)
+        spec = self.url.split('/')[2]
+        self.assertRaises(Http404, serve, request, spec, 'other.jpg')
+        self.assertRaises(Http404, serve, request, spec[:-1] + 'A',
+                          RELATIVE_PIC_NAME)
+        spec = get_url('missing.jpg', 80, 60).split('/')[2]
+        self.assertRaises(Http404, serve, request, spec, 'missing.jpg')
+        self.cache_to_delete.add(os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5('missing.jpg').hexdigest()
+        ))
+
+    def test_field_storage(self):
+        location = os.path.join(settings.MEDIA_ROOT, 'cbttestother')
+        field = FakeImage._meta.get_field('image')
+        old_storage = field.storage
+        field.storage = FileSystemStorage(location)
+        image = None
+        try:
+            file = StringIO()
+            Image.new('RGB', PIC_SIZE).save(file, 'JPEG')
+            field.storage.save('cbttestother.jpg',
+                               ContentFile(file.getvalue()))
+            image = FakeImage(image='cbttestother.jpg', misc=1)
+            image.save()
+            dest = os.path.join(self.MEDIA_MIDDLE,
+                                'cbttestother_jpg_80x60_q85_ctf.jpg')
+            self.images_to_delete.add(dest)
+            for name in ('cbttestother.jpg', dest):
+                self.cache_to_delete.add(os.path.join(
+                    settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                    hashlib.md5(smart_str(name)).hexdigest()
+                ))
+
+            url = get_url(image.image, 80, 60, proc='crop')
+            self.assert_(url.endswith('/cbttestother.jpg'))
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Image.open(StringIO(response.content)).size,
+                             (80, 60))
+            self.assert_(default_storage.exists(dest))
+        finally:
+            if image is not None:
+                image.delete()
+            field.storage = old_storage
+            shutil.rmtree(location, ignore_errors=True)
+
+    def test_redirect(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_VIEW_REDIRECT = True
+        try:
+            response = self.client.get(self.url)
+        finally:
+            del settings.CUDDLYBUDDLY_THUMBNAIL_VIEW_REDIRECT
+        self.assertEqual(response.status_code, 302)
+        self.assert_(response['Location'].endswith(
+            default_storage.url(self.dest)
+        ))
+
+    def test_template_tag(self):
+        self.assertEqual(
+            self.render_template('{% thumbnail_url "' + RELATIVE_PIC_NAME +
+                                 '" 80 60 proc="crop" %}'),
+            self.url
+        )
+        self.assertEqual(
+            self.render_template('{% thumbnail_url "' + RELATIVE_PIC_NAME +
+                                 '" 80 60 "crop" %}'),
+            self.url
+        )
+        self.assert_(not default_storage.exists(self.dest))
+
+
+class FormatTests(BaseTest):
+    def setUp(self):
+        super(FormatTests, self).setUp()
+        self.dest = os.path.join(self.MEDIA_MIDDLE,
+                                 'cb-thumbnail-test_jpg_80x60_q85.webp')
+        self.images_to_delete.add(self.dest)
+        self.cache_to_delete.add(os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5(smart_str(self.dest)).hexdigest()
+        ))
+
+    def test_choose_format(self):
+        formats = ('AVIF', 'WEBP')
+        accept = 'image/avif,image/webp,image/*,*/*;q=0.8'
+        self.assertEqual(choose_format(accept, formats),
+                         can_save('AVIF') and 'AVIF' or 'WEBP')
+        self.assertEqual(choose_format('image/webp', formats), 'WEBP')
+        self.assertEqual(choose_format('IMAGE/WEBP;q=0.5', formats), 'WEBP')
+        self.assertEqual(choose_format('image/webp;q=0', formats), None)
+        self.assertEqual(choose_format('image/*,*/*', formats), None)
+        self.assertEqual(choose_format('', formats), None)
+        self.assertEqual(choose_format('image/made-up', ('MADE-UP',)), None)
+        self.assertEqual(get_mime_type('a.webp'), 'image/webp')
+        self.assertEqual(get_mime_type('a.jpg'), 'image/jpeg')
+
+    def test_webp(self):
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, format='webp')
+        self.assertEqual(force_unicode(thumb), self.dest)
+        image = Image.open(default_storage.open(self.dest))
+        self.assertEqual(image.format, 'WEBP')
+        self.assertEqual(image.size, (80, 60))
+        self.assertRaises(ThumbnailException, Thumbnail, RELATIVE_PIC_NAME,
+                          80, 60, format='made-up')
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, format='auto',
+                          generate=False)
+        self.assertEqual(force_unicode(thumb), self.dest[:-5] + '.jpg')
+
+    def test_template(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT='image/webp')
+        source = '{% thumbnail "' + RELATIVE_PIC_NAME + \
+                 '" 80 60 format="auto" %}'
+        self.assertEqual(self.render_template(source, {'request': request}),
+                         self.dest)
+        self.images_to_delete.add(self.dest[:-5] + '.jpg')
+        self.assertEqual(self.render_template(source),
+                         self.dest[:-5] + '.jpg')
+
+    def test_view(self):
+        url = get_url(RELATIVE_PIC_NAME, 80, 60, format='auto')
+        response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Vary'], 'Accept')
+        self.assertEqual(Image.open(StringIO(response.content)).format,
+                         'WEBP')
+        self.images_to_delete.add(self.dest[:-5] + '.jpg')
+        response = self.client.get(url, HTTP_ACCEPT='image/*')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Vary'], 'Accept')
+        self.assertNotEqual(response.content, '')
+        response = self.client.get(get_url(RELATIVE_PIC_NAME, 80, 60),
+                                   HTTP_ACCEPT='image/webp')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assert_(not response.has_header('Vary'))
+
+
 class ModelsTests(BaseTest):
     def test_autodiscover(self):
         thumbnail.autodiscover()
@@ -464,6 +1485,750 @@ class ModelsTests(BaseTest):
         self.assert_(not os.path.exists(cache), 'Should not exist: %s' % cache)
 
 
+class PregenerateCommandTests(BaseTest):
+    def setUp(self):
+        super(PregenerateCommandTests, self).setUp()
+        self.image = FakeImage(image=RELATIVE_PIC_NAME, misc=1)
+        self.image.save()
+        self.resume = os.path.join(settings.MEDIA_ROOT, 'cbttestresume')
+        self.thumbs = []
+        for image in ('80x60_q85.jpg', '40x30_q85_ctf.jpg'):
+            path = os.path.join(self.MEDIA_MIDDLE,
+                                'cb-thumbnail-test_jpg_%s' % image)
+            self.images_to_delete.add(path)
+            self.cache_to_delete.add(os.path.join(
+                settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                hashlib.md5(smart_str(path)).hexdigest()
+            ))
+            self.thumbs.append(path)
+
+    def tearDown(self):
+        self.image.delete()
+        if os.path.exists(self.resume):
+            os.remove(self.resume)
+        super(PregenerateCommandTests, self).tearDown()
+
+    def pregenerate(self, **kwargs):
+        stdout = StringIO()
+        call_command('pregenerate_thumbnails', sizes=['80x60', '40x30:crop'],
+                     models=['cbtfakeapp.FakeImage'], stdout=stdout,
+                     stderr=stdout, **kwargs)
+        return stdout.getvalue()
+
+    def test_pregenerate(self):
+        output = self.pregenerate()
+        self.assert_(output.endswith('2 thumbnails generated, 0 errors\n'),
+                     output)
+        for thumb in self.thumbs:
+            self.assert_(default_storage.exists(thumb))
+        output = self.pregenerate(processes=2)
+        self.assert_(output.endswith('0 thumbnails generated, 0 errors\n'),
+                     output)
+
+    def test_failure(self):
+        failing = [True]
+        class FlakyProcessor(ResizeProcessor):
+            def generate_thumbnail(self, image, width, height):
+                if failing:
+                    raise IOError('Flaky')
+                return super(FlakyProcessor, self).generate_thumbnail(
+                    image, width, height
+                )
+        thumbnail.register_processor('resize', FlakyProcessor, default=True)
+        output = self.pregenerate()
+        self.assert_('IOError: Flaky' in output, output)
+        self.assert_(output.endswith('0 thumbnails generated, 1 errors\n'),
+                     output)
+        del failing[:]
+        output = self.pregenerate()
+        self.assert_(output.endswith('2 thumbnails generated, 0 errors\n'),
+                     output)
+        for thumb in self.thumbs:
+            self.assert_(default_storage.exists(thumb))
+
+    def test_field_storage(self):
+        location = os.path.join(settings.MEDIA_ROOT, 'cbttestother')
+        field = FakeImage._meta.get_field('image')
+        old_storage = field.storage
+        field.storage = FileSystemStorage(location)
+        try:
+            file = StringIO()
+            Image.new('RGB', PIC_SIZE).save(file, 'JPEG')
+            field.storage.save('cbttestother.jpg',
+                               ContentFile(file.getvalue()))
+            self.image.delete()
+            self.image = FakeImage(image='cbttestother.jpg', misc=1)
+            self.image.save()
+            self.cache_to_delete.add(os.path.join(
+                settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                hashlib.md5('cbttestother.jpg').hexdigest()
+            ))
+            for image in ('80x60_q85.jpg', '40x30_q85_ctf.jpg'):
+                path = os.path.join(self.MEDIA_MIDDLE,
+                                    'cbttestother_jpg_%s' % image)
+                self.images_to_delete.add(path)
+                self.cache_to_delete.add(os.path.join(
+                    settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                    hashlib.md5(smart_str(path)).hexdigest()
+                ))
+
+            output = self.pregenerate(processes=2)
+            self.assert_(
+                output.endswith('2 thumbnails generated, 0 errors\n'), output
+            )
+            output = self.pregenerate()
+            self.assert_(
+                output.endswith('0 thumbnails generated, 0 errors\n'), output
+            )
+        finally:
+            field.storage = old_storage
+            shutil.rmtree(location, ignore_errors=True)
+
+    def test_dry_run(self):
+        output = self.pregenerate(dry_run=True, verbosity=1)
+        self.assert_(output.startswith('\n'.join(self.thumbs)), output)
+        self.assert_(
+            output.endswith('2 thumbnails would be generated, 0 errors\n'),
+            output
+        )
+        for thumb in self.thumbs:
+            self.assert_(not default_storage.exists(thumb))
+
+    def test_resume(self):
+        file = open(self.resume, 'w')
+        file.write(RELATIVE_PIC_NAME + '\n')
+        file.close()
+        output = self.pregenerate(resume=self.resume)
+        self.assert_(output.endswith('0 thumbnails generated, 0 errors\n'),
+                     output)
+        os.remove(self.resume)
+        self.pregenerate(resume=self.resume)
+        file = open(self.resume, 'r')
+        self.assertEqual(file.read(), RELATIVE_PIC_NAME + '\n')
+        file.close()
+
+
+class BenchmarkTests(TestCase):
+    def test_time_stages(self):
+        storage = MemoryStorage()
+        data = StringIO()
+        make_image((200, 100), 'P').save(data, 'GIF', transparency=0)
+        storage.save('bench.gif', ContentFile(data.getvalue()))
+        wrapped = default_storage._wrapped
+        default_storage._wrapped = storage
+        try:
+            timings = time_stages(storage, 'bench.gif', 40, 30, 'crop')
+        finally:
+            default_storage._wrapped = wrapped
+        self.assertEqual(sorted(timings.keys()),
+                         sorted(STAGES + ('total',)))
+        self.assert_(timings['decode'] > 0)
+        self.assert_(timings['total'] >= sum([timings[stage]
+                                              for stage in STAGES[1:]]))
+        self.assertEqual(storage.files.keys(), ['bench.gif'])
+        metadata = metadata_module.get_backend()
+        if metadata is not None:
+            metadata.delete(hashlib.md5('bench.gif').hexdigest())
+        self.assertEqual(thumbnail_checked.receivers, [])
+        self.assertEqual(thumbnail_generated.receivers, [])
+
+    def test_compare(self):
+        def results(total, decode):
+            return {
+                'peak_rss': 1000,
+                'throughput': {'local': {'thumbnails_per_second': 1 / total}},
+                'results': [{
+                    'storage': 'local',
+                    'source': 'a.jpg',
+                    'processor': 'crop',
+                    'size': [80, 60],
+                    'stages': {'decode': decode, 'total': total},
+                }],
+            }
+        lines, regressed = compare(results(1.0, 0.1), results(1.05, 0.5))
+        self.assert_(not regressed)
+        self.assertEqual(
+            lines[0],
+            'local a.jpg crop quality 80x60: 1.05x (slower: decode 5.00x)'
+        )
+        lines, regressed = compare(results(1.0, 0.1), results(2.0, 0.1))
+        self.assert_(regressed)
+        self.assertEqual(lines[-1], 'peak RSS: 1000kB, was 1000kB')
+
+    def test_without_resource(self):
+        old_resource = benchmark.resource
+        benchmark.resource = None
+        try:
+            self.assertEqual(benchmark.peak_rss(), None)
+        finally:
+            benchmark.resource = old_resource
+        baseline = {'throughput': {}, 'results': []}
+        self.assertEqual(compare(baseline, dict(baseline, peak_rss=1000)),
+                         ([], False))
+
+
+class SaveOverwriteTests(TestCase):
+    def test_local(self):
+        name = 'cbttestoverwrite/overwrite.txt'
+        try:
+            self.assertEqual(save_overwrite(default_storage, name,
+                                            ContentFile('first')), name)
+            self.assertEqual(save_overwrite(default_storage, name,
+                                            ContentFile('second')), name)
+            file = default_storage.open(name)
+            self.assertEqual(file.read(), 'second')
+            file.close()
+            self.assertEqual(default_storage.listdir('cbttestoverwrite'),
+                             ([], ['overwrite.txt']))
+        finally:
+            default_storage.delete(name)
+            os.rmdir(default_storage.path('cbttestoverwrite'))
+
+    def test_other_storages(self):
+        storage = MemoryStorage()
+        save_overwrite(storage, 'a.txt', ContentFile('first'))
+        save_overwrite(storage, 'a.txt', ContentFile('second'))
+        self.assertEqual(storage.files.keys(), ['a.txt'])
+        self.assertEqual(storage.open('a.txt').read(), 'second')
+
+        saved = []
+        storage.save_overwrite = lambda name, content: saved.append(name)
+        save_overwrite(storage, 'b.txt', ContentFile('first'))
+        self.assertEqual(saved, ['b.txt'])
+        self.assert_('b.txt' not in storage.files)
+
+
+class CountingStorage(RangeMemoryStorage):
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.ranges = []
+
+    def read_range(self, name, start, end):
+        self.ranges.append((start, end))
+        return super(CountingStorage, self).read_range(name, start, end)
+
+
+class RangeFileTests(BaseTest):
+    def setUp(self):
+        super(RangeFileTests, self).setUp()
+        # Noise so that it's too big to fetch in one go.
+        data = StringIO()
+        Image.frombuffer('L', (1000, 750), os.urandom(1000 * 750), 'raw',
+                         'L', 0, 1).save(data, 'PNG')
+        self.data = data.getvalue()
+        self.storage = CountingStorage()
+        self.storage.save('a.png', ContentFile(self.data))
+
+    def test_read(self):
+        file = RangeFile(self.storage, 'a.png', block_size=100,
+                         max_block_size=1000)
+        expected = StringIO(self.data)
+        for offset, whence, size in ((0, 0, 10), (5, 0, 10), (500, 0, 50),
+                                     (-10, 1, 100), (0, 1, 2000),
+                                     (-20, 2, 100), (10, 0, -1)):
+            file.seek(offset, whence)
+            expected.seek(offset, whence)
+            self.assertEqual(file.read(size), expected.read(size))
+            self.assertEqual(file.tell(), expected.tell())
+        self.assertEqual(file.fetched, len(self.data))
+        self.assertEqual(sum([e - s for s, e in self.storage.ranges]),
+                         len(self.data))
+        file.close()
+        self.assertRaises(ValueError, file.read)
+
+        del self.storage.ranges[:]
+        file = RangeFile(self.storage, 'a.png', block_size=100,
+                         max_block_size=300)
+        for i in range(4):
+            file.read(100)
+        self.assertEqual(self.storage.ranges, [(0, 100), (100, 300),
+                                               (300, 600)])
+        file.close()
+        self.assert_(isinstance(open_source(self.storage, 'a.png'),
+                                RangeFile))
+        storage = MemoryStorage()
+        storage.save('a.png', ContentFile(self.data))
+        self.assert_(not isinstance(open_source(storage, 'a.png'),
+                                    RangeFile))
+
+    def test_probe_and_generate(self):
+        wrapped = default_storage._wrapped
+        default_storage._wrapped = self.storage
+        try:
+            self.assertEqual(probe('a.png'), (1000, 750, 'PNG'))
+            self.assertEqual(self.storage.ranges, [(0, 16 * 2**10)])
+            self.assert_(len(self.data) > 10 * 16 * 2**10)
+            del self.storage.ranges[:]
+            for name in ('a.png', 'a_80x60.png'):
+                self.cache_to_delete.add(os.path.join(
+                    settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                    hashlib.md5(name).hexdigest()
+                ))
+            thumb = Thumbnail('a.png', 80, 60, dest='a_80x60.png',
+                              background=False)
+            self.assertEqual(Image.open(self.storage.open(thumb.dest)).size,
+                             (80, 60))
+            self.assertEqual(sum([e - s for s, e in self.storage.ranges]),
+                             len(self.data))
+            self.assert_(len(self.storage.ranges) < 10)
+        finally:
+            default_storage._wrapped = wrapped
+
+
+class StorageTests(BaseTest):
+    def setUp(self):
+        super(StorageTests, self).setUp()
+        self.source_storage = MemoryStorage()
+        self.dest_storage = MemoryStorage()
+        data = StringIO()
+        Image.new('RGB', PIC_SIZE).save(data, 'JPEG')
+        self.source_storage.save('a.jpg', ContentFile(data.getvalue()))
+        # Freshness is checked against the storages themselves.
+        settings.CUDDLYBUDDLY_THUMBNAIL_CACHE = None
+
+    def test_separate_storages(self):
+        thumb = Thumbnail('a.jpg', 80, 60, source_storage=self.source_storage,
+                          dest_storage=self.dest_storage, background=False)
+        dest = force_unicode(thumb)
+        self.assert_(thumb.generated)
+        self.assert_(self.dest_storage.exists(dest))
+        self.assert_(not self.source_storage.exists(dest))
+        self.assert_(not default_storage.exists(dest))
+        self.assertEqual(thumb.url, dest)
+        self.assertEqual(thumb.dimensions, (80, 60))
+
+        thumb = Thumbnail('a.jpg', 80, 60, source_storage=self.source_storage,
+                          dest_storage=self.dest_storage, generate=False)
+        self.assert_(not thumb.is_stale())
+        self.assertEqual(thumb.dimensions, (80, 60))
+        time.sleep(0.01)
+        self.source_storage.files['a.jpg'] = (
+            self.source_storage.files['a.jpg'][0], time.time()
+        )
+        self.assert_(thumb.is_stale())
+
+    def test_storages_that_read(self):
+        class ReadingStorage(MemoryStorage):
+            def _save(storage, name, content):
+                storage.files[name] = (content.read(), time.time())
+                return name
+
+        dest_storage = ReadingStorage()
+        thumb = Thumbnail('a.jpg', 80, 60, source_storage=self.source_storage,
+                          dest_storage=dest_storage, background=False)
+        data = dest_storage.files[force_unicode(thumb)][0]
+        self.assert_(data)
+        self.assertEqual(Image.open(StringIO(data)).size, (80, 60))
+
+    def test_modified_times(self):
+        times = get_modified_times(default_storage, '')
+        self.assertEqual(times[PIC_NAME],
+                         default_storage.modified_time(PIC_NAME))
+        self.assertEqual(get_modified_times(self.source_storage, ''), {
+            'a.jpg': self.source_storage.modified_time('a.jpg')
+        })
+        storage = Storage()
+        storage.listdir = lambda path: ([], ['a.jpg'])
+        self.assertEqual(get_modified_times(storage, ''), {'a.jpg': None})
+
+    def test_settings(self):
+        path = 'cuddlybuddly.thumbnail.benchmark.MemoryStorage'
+        self.assert_(get_source_storage() is default_storage)
+        settings.CUDDLYBUDDLY_THUMBNAIL_SOURCE_STORAGE = path
+        settings.CUDDLYBUDDLY_THUMBNAIL_DEST_STORAGE = path
+        try:
+            storage = get_source_storage()
+            self.assert_(isinstance(storage, MemoryStorage))
+            self.assert_(get_dest_storage() is storage)
+            self.assert_(get_storage(self.dest_storage) is self.dest_storage)
+            storage.save('a.jpg', self.source_storage.open('a.jpg'))
+            thumb = Thumbnail('a.jpg', 80, 60, background=False)
+            self.assert_(storage.exists(force_unicode(thumb)))
+        finally:
+            del settings.CUDDLYBUDDLY_THUMBNAIL_SOURCE_STORAGE
+            del settings.CUDDLYBUDDLY_THUMBNAIL_DEST_STORAGE
+            storage_module._storages.pop(path, None)
+
+    def test_field_file(self):
+        image = FakeImage(image='a.jpg').image
+        image.storage = self.source_storage
+        thumb = Thumbnail(image, 80, 60, dest_storage=self.dest_storage,
+                          background=False)
+        self.assert_(thumb.source_storage is self.source_storage)
+        self.assert_(self.dest_storage.exists(force_unicode(thumb)))
+        thumb = Thumbnail(image, 80, 60, dest_storage=self.dest_storage,
+                          generate=False)
+        self.assert_(not thumb.is_stale())
+
+
+class CallCountingStorage(MemoryStorage):
+    """
+    Records the name given to every call that would be a request to a remote
+    storage.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CallCountingStorage, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def _get(self, name):
+        self.calls.append(name)
+        return super(CallCountingStorage, self)._get(name)
+
+    def _save(self, name, content):
+        self.calls.append(name)
+        return super(CallCountingStorage, self)._save(name, content)
+
+    def exists(self, name):
+        self.calls.append(name)
+        return super(CallCountingStorage, self).exists(name)
+
+    def listdir(self, path):
+        self.calls.append(path)
+        return super(CallCountingStorage, self).listdir(path)
+
+
+class LazyTests(BaseTest):
+    def setUp(self):
+        super(LazyTests, self).setUp()
+        self.storage = CallCountingStorage()
+        data = StringIO()
+        Image.new('RGB', PIC_SIZE).save(data, 'JPEG')
+        self.storage.save('a.jpg', ContentFile(data.getvalue()))
+        self.calls = self.storage.calls
+        del self.calls[:]
+        settings.CUDDLYBUDDLY_THUMBNAIL_CACHE = None
+
+    def test_lazy(self):
+        thumb = Thumbnail('a.jpg', 80, 60, source_storage=self.storage,
+                          dest_storage=self.storage, lazy=True)
+        self.assertEqual(thumb._processor, None)
+        dest = force_unicode(thumb)
+        self.assert_(dest.endswith('a_jpg_80x60_q85.jpg'), dest)
+        self.assertEqual(self.calls, [])
+        self.assert_(not thumb.exists)
+        self.assert_(not thumb.exists)
+        self.assertEqual(self.calls, [dest])
+        self.assertEqual(thumb.url, dest)
+        self.assert_(thumb.generated)
+        del self.calls[:]
+        self.assertEqual(thumb.url, dest)
+        self.assert_(thumb.exists)
+        self.assertEqual(self.calls, [])
+        self.assertRaises(NotImplementedError, getattr, thumb, 'path')
+
+        thumb = Thumbnail('a.jpg', 80, 60, source_storage=self.storage,
+                          dest_storage=self.storage, lazy=True)
+        thumb.url
+        self.assert_(not thumb.generated)
+
+    def test_errors(self):
+        thumb = Thumbnail('a.jpg', 80, 60, source_storage=self.storage,
+                          lazy=True, resample='bogus')
+        self.assertRaises(ThumbnailException, getattr, thumb, 'url')
+        self.assertRaises(ThumbnailException, Thumbnail, 'a.jpg', 'a', 60,
+                          lazy=True)
+
+
+class BulkTests(BaseTest):
+    def setUp(self):
+        super(BulkTests, self).setUp()
+        self.storage = CallCountingStorage()
+        data = StringIO()
+        Image.new('RGB', PIC_SIZE).save(data, 'JPEG')
+        self.sources = ['a.jpg', 'b.jpg', '', 'c.jpg']
+        for name in self.sources:
+            if name:
+                self.storage.save(name, ContentFile(data.getvalue()))
+        del self.storage.calls[:]
+
+    def resolve(self, **kwargs):
+        return resolve_many(self.sources, 80, 60,
+                            source_storage=self.storage,
+                            dest_storage=self.storage, **kwargs)
+
+    def verify(self, thumbs):
+        self.assertEqual(thumbs[2], None)
+        for thumb in [thumbs[0], thumbs[1], thumbs[3]]:
+            self.assert_(self.storage.exists(force_unicode(thumb)))
+            self.assertEqual(thumb.url, force_unicode(thumb))
+            self.assertEqual(thumb.dimensions, (80, 60))
+
+    def test_metadata(self):
+        thumbs = self.resolve(workers=2)
+        for thumb in thumbs:
+            if thumb is not None:
+                for key in thumb._get_metadata_keys():
+                    self.cache_to_delete.add(os.path.join(
+                        settings.CUDDLYBUDDLY_THUMBNAIL_CACHE, key
+                    ))
+        self.assertEqual(len([t for t in thumbs if t and t.generated]), 3)
+        self.verify(thumbs)
+
+        del self.storage.calls[:]
+        thumbs = self.resolve()
+        self.assertEqual([t.url for t in thumbs if t],
+                         [force_unicode(t) for t in thumbs if t])
+        self.assertEqual(self.storage.calls, [])
+        self.assertEqual([t for t in thumbs if t and t.generated], [])
+        self.verify(thumbs)
+
+    def test_listing(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_CACHE = None
+        thumbs = self.resolve()
+        self.assertEqual(len([t for t in thumbs if t and t.generated]), 3)
+        directory = os.path.dirname(force_unicode(thumbs[0]))
+        self.assertEqual(self.storage.calls.count(directory), 1)
+        self.verify(thumbs)
+
+        # The listing gives the thumbnails' modification times, leaving
+        # only each source's time to ask for and its header to read for the
+        # dimensions.
+        del self.storage.calls[:]
+        thumbs = self.resolve()
+        self.assertEqual([t for t in thumbs if t and t.generated], [])
+        self.assertEqual(self.storage.calls,
+                         [directory] + ['a.jpg', 'b.jpg', 'c.jpg'] * 2)
+        del self.storage.calls[:]
+        self.assertEqual([t.dimensions for t in thumbs if t], [(80, 60)] * 3)
+        self.assertEqual([t.url for t in thumbs if t],
+                         [force_unicode(t) for t in thumbs if t])
+        self.assertEqual(self.storage.calls, [])
+        self.verify(thumbs)
+
+        # A changed source is noticed without a metadata backend too.
+        time.sleep(0.01)
+        data = self.storage.files['b.jpg'][0]
+        self.storage.delete('b.jpg')
+        self.storage.save('b.jpg', ContentFile(data))
+        thumbs = self.resolve()
+        self.assertEqual([bool(t and t.generated) for t in thumbs],
+                         [False, True, False, False])
+        self.verify(thumbs)
+
+    def test_field(self):
+        class Product(object):
+            def __init__(self, image):
+                self.image = image
+        settings.CUDDLYBUDDLY_THUMBNAIL_CACHE = None
+        products = [Product(name) for name in self.sources]
+        thumbs = resolve_many(products, 80, 60, field='image',
+                              source_storage=self.storage,
+                              dest_storage=self.storage)
+        self.verify(thumbs)
+
+
+class ExecutorTests(BaseTest):
+    def test_serial(self):
+        future = SerialExecutor().submit(int, ('1',), lambda value: value + 1)
+        self.assert_(future.done())
+        self.assertEqual(future.result(), 2)
+        future = SerialExecutor().submit(int, ('a',))
+        self.assertRaises(ValueError, future.result)
+
+    def test_backpressure(self):
+        executor = ThreadExecutor(workers=1, max_pending=1)
+        event = threading.Event()
+        submitted = []
+        def submit():
+            submitted.append(executor.submit(int, ('2',)))
+        try:
+            first = executor.submit(event.wait, (5,))
+            thread = threading.Thread(target=submit)
+            thread.start()
+            time.sleep(0.05)
+            self.assertEqual(submitted, [])
+            self.assert_(not first.done())
+            event.set()
+            thread.join()
+            self.assertEqual(submitted[0].result(), 2)
+        finally:
+            event.set()
+            executor.shutdown()
+
+    def test_generate_async(self):
+        executor = ThreadExecutor(workers=2)
+        try:
+            thumbs = [Thumbnail(RELATIVE_PIC_NAME, size[0], size[1],
+                                generate=False)
+                      for size in ((80, 60), (40, 30))]
+            futures = [thumb.generate_async(executor) for thumb in thumbs]
+            self.assertEqual([f.result(5) for f in futures], thumbs)
+        finally:
+            executor.shutdown()
+        self.verify_thumb(thumbs[0], 80, 60, '80x60_q85.jpg')
+        self.verify_thumb(thumbs[1], 40, 30, '40x30_q85.jpg')
+        self.assert_(thumbs[0].generated)
+        thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, generate=False)
+        future = thumb.generate_async(SerialExecutor())
+        self.assert_(future.done())
+        self.assert_(not future.result().generated)
+
+    def test_done_callbacks(self):
+        called = []
+        future = SerialExecutor().submit(int, ('1',))
+        future.add_done_callback(called.append)
+        self.assertEqual(called, [future])
+
+        executor = ThreadExecutor(workers=1)
+        event = threading.Event()
+        done = threading.Event()
+        try:
+            future = executor.submit(event.wait, (5,))
+            future.add_done_callback(called.append)
+            future.add_done_callback(lambda f: done.set())
+            self.assertEqual(len(called), 1)
+            event.set()
+            done.wait(5)
+            self.assertEqual(called, [called[0], future])
+        finally:
+            event.set()
+            executor.shutdown()
+
+    def test_thumbnail_async(self):
+        executor = ThreadExecutor(workers=1)
+        ready = threading.Event()
+        try:
+            future = thumbnail_async(RELATIVE_PIC_NAME, 80, 60,
+                                     executor=executor)
+            future.add_done_callback(lambda f: ready.set())
+            ready.wait(5)
+            self.assert_(future.done())
+            thumb = future.result()
+        finally:
+            executor.shutdown()
+        self.assert_(thumb.generated)
+        self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+
+    def test_thumbnail_async_never_blocks(self):
+        event = threading.Event()
+        futures = []
+        def ask(executor, source, **kwargs):
+            thread = threading.Thread(target=lambda: futures.append(
+                thumbnail_async(source, 80, 60, executor=executor, **kwargs)
+            ))
+            thread.start()
+            thread.join(5)
+            self.assert_(not thread.isAlive())
+            self.assertRaises(ExecutorFull, futures.pop().result)
+
+        executor = ThreadExecutor(workers=1, max_pending=1)
+        try:
+            executor.submit(event.wait, (5,))
+            ask(executor, RELATIVE_PIC_NAME)
+        finally:
+            event.set()
+            executor.shutdown()
+
+        # Files can't be sent to another process and go to its threads.
+        event.clear()
+        executor = ProcessExecutor(workers=1, max_pending=1)
+        file = default_storage.open(PIC_NAME, 'rb')
+        try:
+            executor.local.submit(event.wait, (5,))
+            ask(executor, file, dest=StringIO())
+        finally:
+            event.set()
+            file.close()
+            executor.shutdown()
+
+    def test_processes(self):
+        executor = ProcessExecutor(workers=1)
+        try:
+            thumb = Thumbnail(RELATIVE_PIC_NAME, 80, 60, generate=False)
+            self.assertEqual(thumb.generate_async(executor).result(10), thumb)
+            self.assert_(thumb.generated)
+            self.assertEqual(thumb.dimensions, (80, 60))
+            self.verify_thumb(thumb, 80, 60, '80x60_q85.jpg')
+
+            # Files can't be sent to another process.
+            file = default_storage.open(PIC_NAME, 'rb')
+            try:
+                thumb = Thumbnail(file, 40, 30, dest=StringIO(),
+                                  generate=False)
+                self.assertEqual(thumb.generate_async(executor).result(),
+                                 thumb)
+                self.assertEqual(Image.open(thumb.dest).size, (40, 30))
+            finally:
+                file.close()
+        finally:
+            executor.shutdown()
+
+
+class SourceCacheTests(BaseTest):
+    def setUp(self):
+        super(SourceCacheTests, self).setUp()
+        self.location = tempfile.mkdtemp()
+        self.opened = []
+        class OpenCountingStorage(MemoryStorage):
+            def _open(storage, name, mode='rb'):
+                self.opened.append(name)
+                return MemoryStorage._open(storage, name, mode)
+        self.storage = OpenCountingStorage()
+        data = StringIO()
+        Image.new('RGB', PIC_SIZE).save(data, 'JPEG')
+        self.storage.save('a.jpg', ContentFile(data.getvalue()))
+        self.storage.save('b.jpg', ContentFile(data.getvalue()))
+
+    def tearDown(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+        super(SourceCacheTests, self).tearDown()
+
+    def test_open(self):
+        cache = SourceCache(self.location, 2**20)
+        file = cache.open(self.storage, 'a.jpg')
+        self.assertEqual(file.read(), self.storage.open('a.jpg').read())
+        file.close()
+        cache.open(self.storage, 'a.jpg').close()
+        self.assertEqual(self.opened, ['a.jpg', 'a.jpg'])
+        self.assertEqual(len(os.listdir(self.location)), 1)
+
+        # A changed source is downloaded again.
+        time.sleep(0.01)
+        self.storage.delete('a.jpg')
+        self.storage.save('a.jpg', ContentFile('changed'))
+        file = cache.open(self.storage, 'a.jpg')
+        self.assertEqual(file.read(), 'changed')
+        file.close()
+        self.assertEqual(len(os.listdir(self.location)), 2)
+
+    def test_evict(self):
+        size = len(self.storage.files['a.jpg'][0])
+        cache = SourceCache(self.location, size)
+        cache.open(self.storage, 'a.jpg').close()
+        cache.open(self.storage, 'b.jpg').close()
+        self.assertEqual(len(os.listdir(self.location)), 1)
+        del self.opened[:]
+        cache.open(self.storage, 'b.jpg').close()
+        self.assertEqual(self.opened, [])
+        cache.open(self.storage, 'a.jpg').close()
+        self.assertEqual(self.opened, ['a.jpg'])
+
+    def test_generate(self):
+        settings.CUDDLYBUDDLY_THUMBNAIL_SOURCE_CACHE = self.location
+        wrapped = default_storage._wrapped
+        default_storage._wrapped = self.storage
+        try:
+            self.assert_(isinstance(get_source_cache(), SourceCache))
+            for size in ((80, 60), (40, 30)):
+                dest = 'a_%sx%s.jpg' % size
+                self.cache_to_delete.add(os.path.join(
+                    settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+                    hashlib.md5(dest).hexdigest()
+                ))
+                Thumbnail('a.jpg', size[0], size[1], dest=dest)
+                self.assert_(self.storage.exists(dest))
+        finally:
+            default_storage._wrapped = wrapped
+            del settings.CUDDLYBUDDLY_THUMBNAIL_SOURCE_CACHE
+        self.cache_to_delete.add(os.path.join(
+            settings.CUDDLYBUDDLY_THUMBNAIL_CACHE,
+            hashlib.md5('a.jpg').hexdigest()
+        ))
+        self.assertEqual(self.opened, ['a.jpg'])
+        self.assertEqual(get_source_cache(), None)
+
+
 class ProcessorRegistryTests(BaseTest):
     def test_processor_registry(self):
         self.assertEqual(thumbnail.get_processor('resize'), ResizeProcessor)
@@ -501,6 +2266,33 @@ class ResizeProcessorTests(BaseTest):
             proc = ResizeProcessor(upscale=test[0])
             thumb = proc.generate_thumbnail(image, *test[1])
             self.assertEqual(thumb.size, test[2])
+            self.assertEqual(proc.get_size(PIC_SIZE, *test[1]), test[2])
+
+    def test_get_decode_size(self):
+        tests = (
+            (False, (400, 300), (400, 300)),
+            (False, (400, 400), (400, 300)),
+            (False, (800, 600), None),
+            (True, (1600, 1200), None),
+        )
+        for test in tests:
+            proc = ResizeProcessor(upscale=test[0])
+            self.assertEqual(proc.get_decode_size(PIC_SIZE, *test[1]), test[2])
+
+    def test_resample(self):
+        image = make_image((1600, 1200), 'RGB')
+        best = image.resize((80, 60), Image.ANTIALIAS)
+        thumb = ResizeProcessor().generate_thumbnail(image, 80, 60)
+        self.assertEqual(ImageChops.difference(thumb, best).getbbox(), None)
+        for resample in ('balanced', 'fast'):
+            thumb = ResizeProcessor(resample=resample).generate_thumbnail(
+                image, 80, 60
+            )
+            self.assertEqual(thumb.size, (80, 60))
+            difference = ImageStat.Stat(ImageChops.difference(thumb, best))
+            self.assert_(max(difference.mean) < 8)
+        self.assertRaises(ThumbnailException, Thumbnail, RELATIVE_PIC_NAME,
+                          80, 60, resample='bad', generate=False)
 
 
 class CropToFitProcessorTests(BaseTest):
@@ -525,3 +2317,43 @@ class CropToFitProcessorTests(BaseTest):
             proc = CropToFitProcessor(upscale=test[0])
             thumb = proc.generate_thumbnail(image, *test[1])
             self.assertEqual(thumb.size, test[2])
+            self.assertEqual(proc.get_size(PIC_SIZE, *test[1]), test[2])
+
+    def test_get_decode_size(self):
+        tests = (
+            ((400, 300), (400, 300)),
+            ((400, 100), (400, 300)),
+            ((100, 300), (400, 300)),
+            ((801, 600), None),
+        )
+        for test in tests:
+            proc = CropToFitProcessor()
+            self.assertEqual(proc.get_decode_size(PIC_SIZE, *test[0]), test[1])
+
+    def test_crop_before_resize(self):
+        proc = CropToFitProcessor()
+        for size in ((1600, 1200), (3000, 400), (300, 2000), (333, 331),
+                     (50, 40)):
+            for mode in ('RGB', 'RGBA', 'P', 'L', 'CMYK'):
+                image = make_image(size, mode)
+                for width, height in ((80, 80), (80, 60), (45, 200)):
+                    thumb = proc.generate_thumbnail(image, width, height)
+                    fit = ImageOps.fit(proc._colorspace(image),
+                                       (width, height), Image.ANTIALIAS)
+                    self.assertEqual(thumb.mode, fit.mode)
+                    self.assertEqual(
+                        ImageChops.difference(thumb, fit).getbbox(), None
+                    )
+
+    def test_resample(self):
+        image = make_image((1600, 1200), 'RGB')
+        best = ImageOps.fit(image, (80, 80), Image.ANTIALIAS)
+        thumb = CropToFitProcessor().generate_thumbnail(image, 80, 80)
+        self.assertEqual(ImageChops.difference(thumb, best).getbbox(), None)
+        for resample in ('balanced', 'fast'):
+            thumb = CropToFitProcessor(resample=resample).generate_thumbnail(
+                image, 80, 80
+            )
+            self.assertEqual(thumb.size, (80, 80))
+            difference = ImageStat.Stat(ImageChops.difference(thumb, best))
+            self.assert_(max(difference.mean) < 8)
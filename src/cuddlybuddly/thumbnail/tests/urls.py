@@ -8,4 +8,5 @@ thumbnail.autodiscover()
 
 urlpatterns = patterns('',
     (r'^admin/doc/', include('django.contrib.admindocs.urls')),
+    (r'^thumbs/', include('cuddlybuddly.thumbnail.urls')),
 )
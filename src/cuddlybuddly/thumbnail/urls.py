@@ -0,0 +1,7 @@
+from django.conf.urls import patterns, url
+
+
+urlpatterns = patterns('cuddlybuddly.thumbnail.views',
+    url(r'^(?P<spec>[^/]+)/(?P<path>.+)$', 'serve',
+        name='cuddlybuddly-thumbnail'),
+)
@@ -0,0 +1,149 @@
+import hashlib
+import time
+from wsgiref.util import FileWrapper
+from django.conf import settings
+from django.core import signing
+from django.core.urlresolvers import reverse
+from django.db.models import get_model
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.files import FieldFile
+from django.http import Http404, HttpResponse, HttpResponseNotModified, \
+    HttpResponseRedirect
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.http import http_date, parse_http_date_safe
+from cuddlybuddly.thumbnail.exceptions import ThumbnailException
+from cuddlybuddly.thumbnail.formats import choose_format, get_mime_type
+from cuddlybuddly.thumbnail.main import Thumbnail
+from cuddlybuddly.thumbnail.spec import dumps, loads
+
+
+def get_url(source, width, height, dest=None, proc=None, *args, **kwargs):
+    """
+    Return the url of ``serve()`` for a thumbnail without generating it. The
+    size, processor and options are signed along with the source's path so
+    that nobody else can ask for thumbnails that were never linked to.
+
+    Only a path fits in the url, so a model's file field is named in the spec
+    for ``serve()`` to find its storage again.
+    """
+    if dest is not None or args:
+        raise ValueError('Thumbnails served by a view can only be given a '
+                         'source, size, processor and options.')
+    spec = {'w': int(width), 'h': int(height), 'o': kwargs}
+    if proc is not None:
+        spec['p'] = proc
+    if isinstance(source, FieldFile) and 'source_storage' not in kwargs:
+        opts = source.field.model._meta
+        spec['f'] = '%s.%s.%s' % (opts.app_label, opts.object_name,
+                                  source.field.name)
+    source = force_unicode(source)
+    spec = dumps(spec, salt=source)
+    return reverse('cuddlybuddly-thumbnail', kwargs={
+        'spec': spec,
+        'path': source,
+    })
+
+
+def serve(request, spec, path):
+    """
+    Generate the thumbnail described by ``spec`` the first time it's asked for
+    and then either redirect to it or send it with headers to let browsers and
+    caches keep it, depending on ``CUDDLYBUDDLY_THUMBNAIL_VIEW_REDIRECT``.
+
+    Thumbnails given ``format='auto'`` are saved in the best format the
+    ``Accept`` header allows.
+    """
+    try:
+        spec = loads(spec, salt=path)
+    except signing.BadSignature:
+        raise Http404('Invalid thumbnail: %s' % path)
+    # Python < 2.7 does not accept unicode keywords.
+    options = dict([(k.encode('utf-8'), v) for k, v in spec['o'].items()])
+    options['background'] = False
+    if 'f' in spec:
+        options['source_storage'] = _get_field_storage(spec['f'])
+    negotiate = options.get('format') == 'auto'
+    if negotiate:
+        options['format'] = choose_format(
+            request.META.get('HTTP_ACCEPT', '')
+        )
+        if options['format'] is None:
+            del options['format']
+    try:
+        thumb = Thumbnail(path, spec['w'], spec['h'], proc=spec.get('p'),
+                          **options)
+    except ThumbnailException:
+        raise Http404('Thumbnail could not be generated: %s' % path)
+
+    response = _respond(request, thumb, path)
+    if negotiate:
+        patch_vary_headers(response, ('Accept',))
+    return response
+
+
+def _get_field_storage(name):
+    """
+    Return the storage of the file field ``name`` given by ``get_url()``.
+    """
+    app_label, model_name, field = name.split('.')
+    model = get_model(app_label, model_name)
+    if model is None:
+        raise Http404('Model does not exist: %s' % name)
+    try:
+        return model._meta.get_field(field).storage
+    except FieldDoesNotExist:
+        raise Http404('Field does not exist: %s' % name)
+
+
+def _respond(request, thumb, path):
+    dest = force_unicode(thumb)
+
+    if thumb.pending:
+        # Someone else has been generating it for longer than we could wait.
+        placeholder = getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_PLACEHOLDER',
+                              None)
+        if placeholder is not None:
+            return HttpResponseRedirect(settings.MEDIA_URL + placeholder)
+        response = HttpResponse(status=503)
+        response['Retry-After'] = '1'
+        return response
+
+    if getattr(settings, 'CUDDLYBUDDLY_THUMBNAIL_VIEW_REDIRECT', False):
+        return HttpResponseRedirect(thumb.dest_storage.url(dest))
+
+    try:
+        modified = thumb.dest_storage.modified_time(dest)
+    except EnvironmentError:
+        # The source doesn't exist.
+        raise Http404('Thumbnail does not exist: %s' % path)
+    modified = int(time.mktime(modified.timetuple()))
+    etag = '"%s"' % hashlib.md5(
+        smart_str(u'%s:%s' % (dest, modified))
+    ).hexdigest()
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', '')
+    )
+    if if_none_match is not None:
+        not_modified = etag in [e.strip() for e in if_none_match.split(',')] \
+                       or if_none_match.strip() == '*'
+    else:
+        not_modified = if_modified_since is not None and \
+                       modified <= if_modified_since
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        file = thumb.dest_storage.open(dest, 'rb')
+        response = HttpResponse(
+            FileWrapper(file),
+            content_type=get_mime_type(dest)
+        )
+        response['Content-Length'] = str(file.size)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified)
+    patch_cache_control(response, public=True, max_age=getattr(
+        settings, 'CUDDLYBUDDLY_THUMBNAIL_VIEW_MAX_AGE', 86400
+    ))
+    return response